@@ -0,0 +1,71 @@
+""" Compare the old ORM read paths of Users.get and Groups.get with the
+single-query column projections that replaced them.
+
+    python -m benchmarks.bench_reads [--users N] [--groups N] ...
+"""
+import argparse
+import json
+
+from userapi.database import db
+from userapi.database.model import (GroupModel, UserModel,
+                                    get_group_members, get_user)
+
+from benchmarks.common import BenchApp, QueryCounter, percentile, seed, timed
+
+
+def orm_get_user(userid):
+    keys = ['userid', 'first_name', 'last_name', 'groups']
+    user = UserModel.query.filter_by(userid=userid).first()
+    return dict((key, getattr(user, key)) for key in keys)
+
+
+def orm_get_group(groupid):
+    group = GroupModel.query.filter_by(groupid=groupid).first()
+    if len(group.users) == 0:
+        return None
+    return group.users
+
+
+def measure(fn, arg, iterations):
+    # a fresh session per call, as each request would get
+    def call():
+        fn(arg)
+        db.session.remove()
+
+    with QueryCounter(db.engine) as counter:
+        call()
+
+    samples = timed(call, iterations)
+    return {'queries': counter.count,
+            'p50_ms': round(percentile(samples, 50), 3),
+            'p99_ms': round(percentile(samples, 99), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--per-user', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    bench = BenchApp()
+    try:
+        with bench.app.app_context():
+            seed(args.users, args.groups, args.per_user)
+
+            results = {}
+            for name, fn, arg in [
+                    ('users.get/orm', orm_get_user, 'user1'),
+                    ('users.get/projected', get_user, 'user1'),
+                    ('groups.get/orm', orm_get_group, 'group1'),
+                    ('groups.get/projected', get_group_members, 'group1')]:
+                results[name] = measure(fn, arg, args.iterations)
+
+        print(json.dumps(results, indent=2, sort_keys=True))
+    finally:
+        bench.close()
+
+
+if __name__ == '__main__':
+    main()
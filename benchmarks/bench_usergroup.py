@@ -0,0 +1,93 @@
+""" Compare membership lookups on the original usergroup table (no keys,
+no indexes) with the keyed and indexed one.
+
+    python -m benchmarks.bench_usergroup [--users N] [--groups N] ...
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+
+from sqlalchemy import create_engine
+
+from userapi.database import db
+from userapi.database.model import usergroup
+
+from benchmarks.common import percentile, timed
+
+LEGACY = 'CREATE TABLE usergroup (user_id INTEGER, group_id INTEGER)'
+
+LOOKUPS = {
+    'by_group': 'SELECT user_id FROM usergroup WHERE group_id = ?',
+    'by_user': 'SELECT group_id FROM usergroup WHERE user_id = ?',
+    'is_member': 'SELECT 1 FROM usergroup '
+                 'WHERE group_id = ? AND user_id = ? LIMIT 1',
+}
+
+
+def build(path, legacy, args):
+    engine = create_engine('sqlite:///%s' % path)
+    db.metadata.create_all(engine)
+    if legacy:
+        usergroup.drop(engine)
+        engine.execute(LEGACY)
+
+    with engine.begin() as conn:
+        conn.execute('INSERT INTO users (id, userid) VALUES (?, ?)',
+                     [(x, 'user%d' % x) for x in range(args.users)])
+        conn.execute('INSERT INTO groups (id, groupid) VALUES (?, ?)',
+                     [(x, 'group%d' % x) for x in range(args.groups)])
+        conn.execute('INSERT INTO usergroup (user_id, group_id) '
+                     'VALUES (?, ?)',
+                     [(x, (x + y) % args.groups)
+                      for x in range(args.users)
+                      for y in range(args.per_user)])
+
+    return engine
+
+
+def measure(engine, args):
+    rand = random.Random(0)
+    results = {}
+
+    for name, sql in sorted(LOOKUPS.items()):
+        def lookup():
+            params = {'by_group': (rand.randrange(args.groups),),
+                      'by_user': (rand.randrange(args.users),),
+                      'is_member': (rand.randrange(args.groups),
+                                    rand.randrange(args.users))}[name]
+            engine.execute(sql, params).fetchall()
+
+        samples = timed(lookup, args.iterations)
+        results[name] = {'p50_ms': round(percentile(samples, 50), 3),
+                         'p99_ms': round(percentile(samples, 99), 3)}
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--groups', type=int, default=1000)
+    parser.add_argument('--per-user', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='userapi-bench-')
+    try:
+        results = {}
+        for name, legacy in [('legacy', True), ('indexed', False)]:
+            engine = build(os.path.join(tmpdir, '%s.db' % name), legacy,
+                           args)
+            results[name] = measure(engine, args)
+            engine.dispose()
+
+        print(json.dumps(results, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
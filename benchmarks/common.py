@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import event
+
+import userapi.cli
+from userapi.database import db
+from userapi.database.model import UserModel
+
+
+class BenchApp(object):
+    """ a userapi app on a throwaway sqlite database """
+
+    def __init__(self, extra_config=''):
+        self.tmpdir = tempfile.mkdtemp(prefix='userapi-bench-')
+        self.db_path = os.path.join(self.tmpdir, 'bench.db')
+        self.config_path = os.path.join(self.tmpdir, 'bench.conf')
+
+        with open(self.config_path, 'w') as f:
+            f.write('SQLALCHEMY_DATABASE_URI = "sqlite:///%s"\n' %
+                    self.db_path)
+            f.write(extra_config)
+
+        self.app = userapi.cli.create_app(config=self.config_path)
+        db.app = self.app
+        db.metadata.create_all(db.engine)
+
+        self.client = self.app.test_client()
+
+    def close(self):
+        db.session.remove()
+        shutil.rmtree(self.tmpdir)
+
+
+def seed(users, groups, per_user, chunk=5000):
+    """ fill the database with a synthetic directory: users named
+    user<n>, groups named group<n>, each user in per_user groups """
+    for start in range(0, users, chunk):
+        UserModel.upsert_many([
+            {'userid': 'user%d' % x,
+             'first_name': 'first%d' % x,
+             'last_name': 'last%d' % x,
+             'groups': ['group%d' % ((x + y) % groups)
+                        for y in range(per_user)]}
+            for x in range(start, min(users, start + chunk))])
+        db.session.commit()
+
+
+class QueryCounter(object):
+    """ count the sql statements run against an engine """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+
+def timed(fn, iterations):
+    """ run fn repeatedly, returning the list of latencies in ms """
+    samples = []
+    for _ in range(iterations):
+        start = time.time()
+        fn()
+        samples.append((time.time() - start) * 1000)
+    return samples
@@ -0,0 +1,56 @@
+""" Compare two loadtest json reports, flagging latency regressions.
+
+    python -m benchmarks.compare old.json new.json [--threshold PCT]
+
+Exits non-zero if any endpoint's p50 or p99 got worse by more than the
+threshold percentage.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(old, new, threshold):
+    regressions = []
+    for mode in sorted(set(old['results']) & set(new['results'])):
+        for endpoint in sorted(set(old['results'][mode]) &
+                               set(new['results'][mode])):
+            before = old['results'][mode][endpoint]
+            after = new['results'][mode][endpoint]
+
+            for stat in ['p50_ms', 'p99_ms']:
+                change = 0.0
+                if before[stat]:
+                    change = (after[stat] - before[stat]) * 100 / before[stat]
+
+                flag = ''
+                if change > threshold:
+                    flag = '  REGRESSION'
+                    regressions.append((mode, endpoint, stat))
+
+                print('%-7s %-14s %-7s %9.3f -> %9.3f  %+6.1f%%%s' % (
+                    mode, endpoint, stat, before[stat], after[stat], change,
+                    flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=20.0)
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print('%s -> %s' % (old.get('commit'), new.get('commit')))
+    if compare(old, new, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+""" Load test the REST API against a synthetic directory.
+
+Seeds users x groups x memberships-per-user, then drives each endpoint
+in-process through the flask test client and over a real socket, and
+prints throughput and latency percentiles per endpoint as json.
+
+    python -m benchmarks.loadtest [--users N] [--groups N] ...
+"""
+import argparse
+import json
+import random
+import subprocess
+import threading
+import time
+
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmarks.common import BenchApp, percentile, seed
+
+
+def _user(rand, args):
+    return 'user%d' % rand.randrange(args.users)
+
+
+def _group(rand, args):
+    return 'group%d' % rand.randrange(args.groups)
+
+
+# endpoint name -> function of (random, args) giving (method, path, body)
+ENDPOINTS = {
+    'get_user': lambda r, a: ('GET', '/users/%s' % _user(r, a), None),
+    'get_group': lambda r, a: ('GET', '/groups/%s' % _group(r, a), None),
+    'list_users': lambda r, a: ('GET', '/users/?limit=100', None),
+    'list_groups': lambda r, a: ('GET', '/groups/?limit=100', None),
+    'update_user': lambda r, a: (
+        'PUT', '/users/%s' % _user(r, a),
+        json.dumps({'first_name': 'first%d' % r.randrange(1000)})),
+    'add_member': lambda r, a: (
+        'POST', '/groups/%s/members/%s' % (_group(r, a), _user(r, a)),
+        None),
+}
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def summarize(samples, errors, elapsed):
+    return {'requests': len(samples),
+            'errors': errors,
+            'rps': round(len(samples) / elapsed, 1) if elapsed else None,
+            'p50_ms': round(percentile(samples, 50), 3),
+            'p99_ms': round(percentile(samples, 99), 3)}
+
+
+def run_inproc(client, endpoint, args):
+    rand = random.Random(0)
+    samples = []
+    errors = 0
+
+    begin = time.time()
+    for _ in range(args.requests):
+        method, path, body = ENDPOINTS[endpoint](rand, args)
+        start = time.time()
+        resp = client.open(path, method=method, data=body,
+                           content_type='application/json')
+        samples.append((time.time() - start) * 1000)
+        errors += resp.status_code >= 500
+
+    return summarize(samples, errors, time.time() - begin)
+
+
+def run_socket(port, endpoint, args):
+    samples = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(seed_value, count):
+        rand = random.Random(seed_value)
+        conn = HTTPConnection('127.0.0.1', port)
+        mine = []
+        failed = 0
+        for _ in range(count):
+            method, path, body = ENDPOINTS[endpoint](rand, args)
+            start = time.time()
+            conn.request(method, path, body,
+                         {'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            resp.read()
+            mine.append((time.time() - start) * 1000)
+            failed += resp.status >= 500
+        conn.close()
+
+        with lock:
+            samples.extend(mine)
+            errors[0] += failed
+
+    per_thread = max(1, args.requests // args.concurrency)
+    threads = [threading.Thread(target=worker, args=(x, per_thread))
+               for x in range(args.concurrency)]
+
+    begin = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(samples, errors[0], time.time() - begin)
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--per-user', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='client threads for the socket run')
+    parser.add_argument('--mode', choices=['inproc', 'socket', 'both'],
+                        default='both')
+    parser.add_argument('--endpoint', action='append',
+                        choices=sorted(ENDPOINTS),
+                        help='endpoints to run, defaults to all')
+    parser.add_argument('--config', default='',
+                        help='extra config lines, e.g. "CACHE_SIZE = 0"')
+    parser.add_argument('--output', help='file to write the json to')
+    args = parser.parse_args()
+
+    bench = BenchApp(args.config.replace('\\n', '\n') + '\n')
+    report = {'commit': _commit(),
+              'config': vars(args),
+              'results': {}}
+
+    try:
+        with bench.app.app_context():
+            seed(args.users, args.groups, args.per_user)
+
+        endpoints = args.endpoint or sorted(ENDPOINTS)
+
+        if args.mode in ['inproc', 'both']:
+            report['results']['inproc'] = dict(
+                (x, run_inproc(bench.client, x, args)) for x in endpoints)
+
+        if args.mode in ['socket', 'both']:
+            server = make_server('127.0.0.1', 0, bench.app, threaded=True,
+                                 request_handler=QuietHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            try:
+                report['results']['socket'] = dict(
+                    (x, run_socket(server.server_port, x, args))
+                    for x in endpoints)
+            finally:
+                server.shutdown()
+    finally:
+        bench.close()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,4 +10,4 @@ if [ ! -e /app/userapi.db ]; then
 fi
 
 pushd /app
-python ./manage.py -c /app/userapi.conf runserver -h 0.0.0.0
+python ./manage.py -c /app/userapi.conf serve -h 0.0.0.0
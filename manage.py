@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 
+import json
+import sys
+import time
+
 import userapi
 import userapi.cli
 
+from flask import current_app
 from flask.ext.script import Manager
 
 from userapi.database import db
+from userapi.database.migrate import upgrade
+from userapi.database.model import iter_users
+from userapi.nss import export_nss as export_nss_files
+from userapi.server import serve as serve_app
+from userapi.snapshot import compile_snapshot as compile_snapshot_file
 
 
 manager = Manager(userapi.cli.create_app)
@@ -20,4 +30,65 @@ def create_db():
     db.metadata.create_all(db.engine)
 
 
+@manager.command
+def upgrade_db():
+    """Upgrades an existing database to the current schema"""
+    upgrade(db.engine)
+
+
+@manager.option('-h', '--host', dest='host', required=False)
+@manager.option('-p', '--port', dest='port', type=int, required=False)
+@manager.option('-w', '--workers', dest='workers', type=int, required=False)
+@manager.option('-t', '--threads', dest='threads', type=int, required=False)
+def serve(host=None, port=None, workers=None, threads=None):
+    """Runs the production server"""
+    app = current_app._get_current_object()
+    config = app.config
+
+    serve_app(app,
+              host or config['HOST'],
+              port or int(config['PORT']),
+              workers or config['SERVER_WORKERS'],
+              threads or config['SERVER_THREADS'])
+
+
+@manager.option('-o', '--output', dest='output', required=False,
+                help='file to write to, defaults to stdout')
+def export(output=None):
+    """Writes every user as newline delimited json"""
+    f = sys.stdout if output is None else open(output, 'w')
+
+    try:
+        for user in iter_users():
+            f.write(json.dumps(user) + '\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+@manager.option('-o', '--output', dest='output', required=True,
+                help='snapshot file to write')
+def compile_snapshot(output):
+    """Compiles the database into a read-only snapshot file"""
+    users, groups = compile_snapshot_file(output)
+    print('Wrote %d users and %d groups to %s' % (users, groups, output))
+
+
+@manager.option('-d', '--directory', dest='directory', required=True,
+                help='directory to write passwd and group files to')
+@manager.option('-i', '--interval', dest='interval', type=float,
+                required=False, help='keep refreshing every so many seconds')
+def export_nss(directory, interval=None):
+    """Writes passwd and group files, updating only what changed"""
+    while True:
+        res = export_nss_files(directory)
+        if res['full'] or res['users'] or res['groups']:
+            print('Wrote %(users)d users and %(groups)d groups' % res)
+
+        if not interval:
+            break
+        db.session.remove()
+        time.sleep(interval)
+
+
 manager.run()
@@ -8,7 +8,15 @@ case "${WHAT}" in
         ;;
     pep8)
 #        pep8 --repeat --show-pep8 --show-source $(dirname $0)/userapi
-        pep8 $(dirname $0)/userapi
-        pyflakes $(dirname $0)/userapi
+        pep8 $(dirname $0)/userapi $(dirname $0)/benchmarks
+        pyflakes $(dirname $0)/userapi $(dirname $0)/benchmarks
+        ;;
+    bench)
+        for bench in $(dirname $0)/benchmarks/bench_*.py; do
+            (cd $(dirname $0) && python -m benchmarks.$(basename ${bench} .py))
+        done
+        ;;
+    loadtest)
+        (cd $(dirname $0) && python -m benchmarks.loadtest --output bench_output.txt)
         ;;
 esac
@@ -1,10 +1,16 @@
+import datetime
 import json
 import os
+import shutil
+import threading
+import time
 import unittest
+import zlib
 import userapi
 import userapi.cli
 
 from userapi.database import db
+from userapi.database.migrate import upgrade
 
 
 class UserApiTestCase(unittest.TestCase):
@@ -15,12 +21,15 @@ class UserApiTestCase(unittest.TestCase):
         with open(self.config_path, 'w') as f:
             f.write('SQLALCHEMY_DATABASE_URI = "sqlite:///%s"\n' % self.db_path)
             f.write('TESTING = True\n')
+            # no job worker threads outliving each test
+            f.write('JOBS_AUTOSTART = False\n')
 
         # hack up some db initialization
         user_app = userapi.cli.create_app(config=self.config_path)
         db.app = user_app
         db.metadata.create_all(db.engine)
 
+        self.user_app = user_app
         self.app = user_app.test_client()
 
     def tearDown(self):
@@ -34,23 +43,13 @@ class UserApiTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 201)
 
     def _add_user_to_group(self, user, group):
-        resp = self.app.get('/users/%s' % user)
-        self.assertEqual(resp.status_code, 200)
-
         resp = self.app.get('/groups/%s' % group)
-
-        current_members = []
         if(resp.status_code == 404):
             resp = self.app.post('/groups/%s' % group)
-            self.assertEqual(resp.status_code, 201)
-        else:
-            current_members = json.loads(resp.data)
+            self.assertTrue(resp.status_code in [201, 409])
 
-        current_members.append(user)
-        resp = self.app.put('/groups/%s' % group,
-                            content_type='application/json',
-                            data=json.dumps(current_members))
-        self.assertEqual(resp.status_code, 200)
+        resp = self.app.post('/groups/%s/members/%s' % (group, user))
+        self.assertEqual(resp.status_code, 201)
 
     def test_010_empty_db(self):
         """ Make sure we have an empty user list """
@@ -98,6 +97,22 @@ class UserApiTestCase(unittest.TestCase):
                              data='{}')
         self.assertEqual(resp.status_code, 409)
 
+    def test_038_invalid_user_fields(self):
+        """ Make sure bodies that aren't user objects are refused """
+        self._create_user('user1')
+        for data in ['[]', '"user"', '{"groups": "group1"}',
+                     '{"groups": [1]}', '{"first_name": 1}']:
+            resp = self.app.post('/users/user2',
+                                 content_type='application/json', data=data)
+            self.assertEqual(resp.status_code, 400)
+
+            resp = self.app.put('/users/user1',
+                                content_type='application/json', data=data)
+            self.assertEqual(resp.status_code, 400)
+
+        resp = self.app.get('/users/user2')
+        self.assertEqual(resp.status_code, 404)
+
     def test_040_delete_user(self):
         """ Make sure we can delete users """
         self._create_user("user1")
@@ -280,3 +295,1168 @@ class UserApiTestCase(unittest.TestCase):
         resp = self.app.put('/groups/admin', content_type='application/json',
                             data='["user2"]')
         self.assertEqual(resp.status_code, 400)
+
+    def test_300_bulk_upsert(self):
+        """ Make sure bulk upserts create and update users and groups """
+        self._create_user('user1')
+        self._add_user_to_group('user1', 'old')
+
+        resp = self.app.post('/users/', content_type='application/json',
+                             data=json.dumps([
+                                 dict(userid='user1', last_name='last',
+                                      groups=['admin']),
+                                 dict(userid='user2', first_name='first',
+                                      groups=['admin', 'users']),
+                                 dict(first_name='nouserid'),
+                                 dict(userid='user2')]))
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual([x['status'] for x in data],
+                         ['updated', 'created', 'error', 'error'])
+
+        resp = self.app.get('/users/user1')
+        data = json.loads(resp.data)
+        self.assertEqual(data['last_name'], 'last')
+        self.assertItemsEqual(data['groups'], ['admin'])
+
+        resp = self.app.get('/users/user2')
+        data = json.loads(resp.data)
+        self.assertEqual(data['first_name'], 'first')
+        self.assertItemsEqual(data['groups'], ['admin', 'users'])
+
+        resp = self.app.get('/groups/admin')
+        self.assertItemsEqual(json.loads(resp.data), ['user1', 'user2'])
+
+        resp = self.app.get('/groups/old')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_310_bulk_upsert_ndjson(self):
+        """ Make sure bulk upserts take ndjson and flag bad lines """
+        resp = self.app.post('/users/', content_type='application/x-ndjson',
+                             data='{"userid": "user1"}\n'
+                                  'NOT JSON\n'
+                                  '\n'
+                                  '{"userid": "user2", "groups": ["g"]}\n')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual([x['status'] for x in data],
+                         ['created', 'error', 'created'])
+
+        resp = self.app.get('/users/')
+        self.assertItemsEqual(json.loads(resp.data), ['user1', 'user2'])
+
+    def test_320_update_group_keeps_members(self):
+        """ Make sure membership updates apply just the difference """
+        for user in ['user1', 'user2', 'user3']:
+            self._create_user(user)
+
+        resp = self.app.post('/groups/group1')
+        self.assertEqual(resp.status_code, 201)
+
+        resp = self.app.put('/groups/group1', content_type='application/json',
+                            data='["user1", "user2"]')
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.app.put('/groups/group1', content_type='application/json',
+                            data='["user2", "user3", "user3"]')
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.app.get('/groups/group1')
+        self.assertItemsEqual(json.loads(resp.data), ['user2', 'user3'])
+
+        resp = self.app.get('/users/user1')
+        self.assertItemsEqual(json.loads(resp.data)['groups'], [])
+
+    def test_330_add_remove_member(self):
+        """ Make sure single members can be added and removed """
+        self._create_user('user1')
+        self._create_user('user2')
+        self._add_user_to_group('user1', 'group1')
+
+        resp = self.app.post('/groups/group1/members/user2')
+        self.assertEqual(resp.status_code, 201)
+        resp = self.app.post('/groups/group1/members/user2')
+        self.assertEqual(resp.status_code, 409)
+
+        resp = self.app.get('/groups/group1')
+        self.assertItemsEqual(json.loads(resp.data), ['user1', 'user2'])
+
+        resp = self.app.delete('/groups/group1/members/user1')
+        self.assertEqual(resp.status_code, 200)
+        resp = self.app.delete('/groups/group1/members/user1')
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.app.get('/users/user1')
+        self.assertItemsEqual(json.loads(resp.data)['groups'], [])
+
+        resp = self.app.post('/groups/group1/members/notauser')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.app.post('/groups/notagroup/members/user1')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_340_paginated_lists(self):
+        """ Make sure user and group lists page with a cursor """
+        resp = self.app.post('/users/', content_type='application/json',
+                             data=json.dumps([
+                                 dict(userid='user%d' % x, groups=['g%d' % x])
+                                 for x in range(5)]))
+        self.assertEqual(resp.status_code, 200)
+
+        for path in ['/users/', '/groups/']:
+            seen = []
+            url = path + '?limit=2'
+            while url:
+                resp = self.app.get(url)
+                self.assertEqual(resp.status_code, 200)
+                page = json.loads(resp.data)
+                self.assertTrue(len(page) <= 2)
+                seen.extend(page)
+
+                url = resp.headers.get('Link')
+                if url:
+                    url = url[url.index('<') + 1:url.index('>')]
+
+            self.assertEqual(seen, sorted(json.loads(
+                self.app.get(path).data)))
+            self.assertEqual(len(seen), 5)
+
+        resp = self.app.get('/users/?limit=0')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.app.get('/users/?limit=junk')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_350_export(self):
+        """ Make sure the export streams every user with groups """
+        resp = self.app.post('/users/', content_type='application/json',
+                             data=json.dumps([
+                                 dict(userid='user1', first_name='first',
+                                      groups=['b', 'a']),
+                                 dict(userid='user2')]))
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.app.get('/export/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+
+        data = [json.loads(x) for x in resp.data.splitlines()]
+        self.assertEqual(data, [
+            dict(userid='user1', first_name='first', last_name='',
+                 groups=['a', 'b']),
+            dict(userid='user2', first_name='', last_name='', groups=[])])
+
+    def test_360_cached_reads(self):
+        """ Make sure reads are cached and writes invalidate them """
+        cache = self.user_app.extensions['userapi_cache']
+
+        self._create_user('user1')
+        self._add_user_to_group('user1', 'group1')
+
+        for _ in range(2):
+            resp = self.app.get('/users/user1')
+            self.assertItemsEqual(json.loads(resp.data)['groups'],
+                                  ['group1'])
+            resp = self.app.get('/groups/group1')
+            self.assertItemsEqual(json.loads(resp.data), ['user1'])
+
+        hits = cache.stats()['hits']
+        self.assertTrue(hits >= 2)
+
+        # the reverse memberships have to go too
+        self._create_user('user2')
+        resp = self.app.put('/groups/group1', content_type='application/json',
+                            data='["user2"]')
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.app.get('/users/user1')
+        self.assertItemsEqual(json.loads(resp.data)['groups'], [])
+        resp = self.app.get('/groups/group1')
+        self.assertItemsEqual(json.loads(resp.data), ['user2'])
+
+        resp = self.app.put('/users/user2', content_type='application/json',
+                            data=json.dumps(dict(groups=['group2'])))
+        self.assertEqual(resp.status_code, 200)
+        resp = self.app.get('/groups/group1')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_370_conditional_get(self):
+        """ Make sure ETags change with the data and 304 otherwise """
+        self._create_user('user1')
+        self._add_user_to_group('user1', 'group1')
+
+        for path in ['/users/user1', '/groups/group1', '/users/',
+                     '/groups/']:
+            resp = self.app.get(path)
+            self.assertEqual(resp.status_code, 200)
+            tag = resp.headers['ETag']
+
+            resp = self.app.get(path, headers={'If-None-Match': tag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], tag)
+
+        resp = self.app.get('/users/user1')
+        user_tag = resp.headers['ETag']
+        resp = self.app.get('/groups/group1')
+        group_tag = resp.headers['ETag']
+
+        # a membership change moves both sides on
+        self._create_user('user2')
+        self._add_user_to_group('user2', 'group1')
+        resp = self.app.delete('/groups/group1/members/user1')
+        self.assertEqual(resp.status_code, 200)
+
+        for path, tag in [('/users/user1', user_tag),
+                          ('/groups/group1', group_tag)]:
+            resp = self.app.get(path, headers={'If-None-Match': tag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], tag)
+
+    def test_380_change_feed(self):
+        """ Make sure writes show up in the change feed in order """
+        resp = self.app.get('/changes/')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data, dict(changes=[], next=0))
+
+        self._create_user('user1')
+        self._add_user_to_group('user1', 'group1')
+
+        resp = self.app.get('/changes/?since=0')
+        data = json.loads(resp.data)
+        since = data['next']
+        self.assertEqual(
+            [(x['type'], x['id'], x['op']) for x in data['changes']],
+            [('user', 'user1', 'update'),
+             ('group', 'group1', 'update'),
+             ('user', 'user1', 'update'),
+             ('group', 'group1', 'update')])
+
+        resp = self.app.delete('/users/user1')
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.app.get('/changes/?since=%d&wait=1' % since)
+        data = json.loads(resp.data)
+        self.assertEqual(
+            [(x['type'], x['id'], x['op']) for x in data['changes']],
+            [('group', 'group1', 'update'),
+             ('user', 'user1', 'delete')])
+
+        # nothing new, so a short long-poll comes back empty
+        resp = self.app.get('/changes/?since=%d&wait=0.1' % data['next'])
+        data2 = json.loads(resp.data)
+        self.assertEqual(data2, dict(changes=[], next=data['next']))
+
+        resp = self.app.get('/changes/?since=junk')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_385_group_changes_touched(self):
+        """ Make sure only groups that gained or lost a member are
+        touched when a user's groups are set """
+        self._create_user('user1')
+        self._add_user_to_group('user1', 'a')
+
+        def changed(fn):
+            since = json.loads(self.app.get('/changes/').data)['next']
+            fn()
+            data = json.loads(self.app.get('/changes/?since=%d' %
+                                           since).data)
+            return sorted((x['type'], x['id']) for x in data['changes'])
+
+        def put(groups):
+            resp = self.app.put('/users/user1',
+                                content_type='application/json',
+                                data=json.dumps({'groups': groups}))
+            self.assertEqual(resp.status_code, 200)
+
+        def upsert(groups):
+            resp = self.app.post('/users/', content_type='application/json',
+                                 data=json.dumps([{'userid': 'user1',
+                                                   'groups': groups}]))
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(changed(lambda: put(['a'])), [('user', 'user1')])
+        self.assertEqual(changed(lambda: upsert(['a'])),
+                         [('user', 'user1')])
+        self.assertEqual(changed(lambda: put(['a', 'b'])),
+                         [('group', 'b'), ('user', 'user1')])
+        self.assertEqual(changed(lambda: upsert(['b', 'c'])),
+                         [('group', 'a'), ('group', 'c'), ('user', 'user1')])
+
+    def test_390_upgrade_db(self):
+        """ Make sure upgrades rebuild old databases and drop dupes """
+        db.session.remove()
+        db.metadata.drop_all(db.engine)
+
+        # the original schema, with duplicate and dangling memberships
+        for sql in [
+                'CREATE TABLE users (id INTEGER PRIMARY KEY, '
+                'userid VARCHAR(50) NOT NULL UNIQUE, '
+                'first_name VARCHAR(50), last_name VARCHAR(50))',
+                'CREATE TABLE groups (id INTEGER PRIMARY KEY, '
+                'groupid VARCHAR(50) NOT NULL UNIQUE)',
+                'CREATE TABLE usergroup (user_id INTEGER, group_id INTEGER)',
+                "INSERT INTO users VALUES (1, 'user1', 'first', 'last')",
+                "INSERT INTO groups VALUES (1, 'group1')",
+                'INSERT INTO usergroup VALUES (1, 1)',
+                'INSERT INTO usergroup VALUES (1, 1)',
+                'INSERT INTO usergroup VALUES (2, 1)']:
+            db.engine.execute(sql)
+
+        upgrade(db.engine)
+
+        rows = db.engine.execute('SELECT * FROM usergroup').fetchall()
+        self.assertEqual([tuple(x) for x in rows], [(1, 1)])
+
+        resp = self.app.get('/users/user1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertItemsEqual(json.loads(resp.data)['groups'], ['group1'])
+
+        self._create_user('user2')
+        self._add_user_to_group('user2', 'group1')
+        resp = self.app.get('/groups/group1')
+        self.assertItemsEqual(json.loads(resp.data), ['user1', 'user2'])
+
+        # and a second run is a no-op
+        upgrade(db.engine)
+
+    def test_400_sqlite_pragmas(self):
+        """ Make sure sqlite connections get the configured pragmas """
+        conn = db.engine.connect()
+        try:
+            self.assertEqual(
+                conn.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(
+                conn.execute('PRAGMA busy_timeout').scalar(), 5000)
+        finally:
+            conn.close()
+
+    def test_410_metrics(self):
+        """ Make sure instrumentation counts queries and exports them """
+        with open(self.config_path, 'a') as f:
+            f.write('METRICS = True\n')
+
+        metrics_app = userapi.cli.create_app(config=self.config_path)
+        db.app = metrics_app
+        client = metrics_app.test_client()
+
+        resp = client.post('/users/user1', content_type='application/json',
+                           data='{}')
+        self.assertEqual(resp.status_code, 201)
+
+        resp = client.get('/users/user1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('queries' in resp.headers['Server-Timing'])
+
+        resp = client.get('/metrics/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue('userapi_request_duration_seconds_count'
+                        '{endpoint="users.users"} 2.0' in resp.data)
+        self.assertTrue('userapi_db_queries_total{endpoint="users.users"}'
+                        in resp.data)
+        self.assertTrue('userapi_cache_misses_total 1.0' in resp.data)
+
+        # and it stays off by default
+        resp = self.app.get('/metrics/')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_420_filtered_user_list(self):
+        """ Make sure user listings filter by prefix, name and group """
+        resp = self.app.post('/users/', content_type='application/json',
+                             data=json.dumps([
+                                 dict(userid='svc-a', first_name='Alice',
+                                      last_name='Smith', groups=['g1']),
+                                 dict(userid='svc-b', first_name='Bob',
+                                      last_name='Jones', groups=['g1', 'g2']),
+                                 dict(userid='user', first_name='Carol',
+                                      last_name='Smithers', groups=['g2'])]))
+        self.assertEqual(resp.status_code, 200)
+
+        for query, expected in [
+                ('prefix=svc-', ['svc-a', 'svc-b']),
+                ('prefix=svc-b', ['svc-b']),
+                ('prefix=nope', []),
+                ('name=smith', ['svc-a', 'user']),
+                ('name=BO', ['svc-b']),
+                ('group=g2', ['svc-b', 'user']),
+                ('group=g1,g2', ['svc-a', 'svc-b', 'user']),
+                ('group=g1&group=g2&match=all', ['svc-b']),
+                ('group=g2&prefix=svc', ['svc-b']),
+                ('name=smith&limit=1', ['svc-a'])]:
+            resp = self.app.get('/users/?%s' % query)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data), expected)
+
+        # the next page keeps the filters
+        resp = self.app.get('/users/?name=smith&limit=1')
+        link = resp.headers['Link']
+        resp = self.app.get(link[link.index('<') + 1:link.index('>')])
+        self.assertEqual(json.loads(resp.data), ['user'])
+
+        # including repeated ones
+        url, names = '/users/?group=g1&group=g2&limit=1', []
+        while url:
+            resp = self.app.get(url)
+            names.extend(json.loads(resp.data))
+            link = resp.headers.get('Link')
+            url = link and link[link.index('<') + 1:link.index('>')]
+        self.assertEqual(names, ['svc-a', 'svc-b', 'user'])
+
+        resp = self.app.get('/users/?group=g1&match=some')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_430_multi_get(self):
+        """ Make sure many users and groups can be fetched at once """
+        resp = self.app.post('/users/', content_type='application/json',
+                             data=json.dumps([
+                                 dict(userid='user1', groups=['g1', 'g2']),
+                                 dict(userid='user2', first_name='first',
+                                      groups=['g1'])]))
+        self.assertEqual(resp.status_code, 200)
+        resp = self.app.post('/groups/empty')
+        self.assertEqual(resp.status_code, 201)
+
+        resp = self.app.get('/users/?ids=user1,user2&ids=nouser')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['nouser'], None)
+        self.assertEqual(data['user1']['groups'], ['g1', 'g2'])
+        self.assertEqual(data['user2'], dict(userid='user2',
+                                             first_name='first',
+                                             last_name='', groups=['g1']))
+
+        resp = self.app.get('/groups/?ids=g1,g2,empty,nogroup')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data),
+                         dict(g1=['user1', 'user2'], g2=['user1'],
+                              empty=[], nogroup=None))
+
+        resp = self.app.get('/users/?ids=' + ','.join(
+            'user%d' % x for x in range(1001)))
+        self.assertEqual(resp.status_code, 400)
+
+    def _nest(self, parent, children, status=200):
+        resp = self.app.put('/groups/%s' % parent,
+                            content_type='application/json',
+                            data=json.dumps(dict(groups=children)))
+        self.assertEqual(resp.status_code, status)
+
+    def test_440_nested_groups(self):
+        """ Make sure nested groups give effective membership """
+        self._create_user('user1')
+        self._add_user_to_group('user1', 'leaf')
+        for group in ['mid', 'top', 'other']:
+            resp = self.app.post('/groups/%s' % group)
+            self.assertEqual(resp.status_code, 201)
+
+        self._nest('mid', ['leaf'])
+        self._nest('top', ['mid'])
+        self._nest('other', ['leaf'])
+
+        resp = self.app.get('/groups/top/subgroups')
+        self.assertEqual(json.loads(resp.data), ['mid'])
+
+        resp = self.app.get('/users/user1/effective-groups')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data),
+                         ['leaf', 'mid', 'other', 'top'])
+
+        resp = self.app.get('/users/user1/effective-groups/top')
+        self.assertEqual(resp.status_code, 204)
+
+        # direct membership is unchanged
+        resp = self.app.get('/users/user1')
+        self.assertEqual(json.loads(resp.data)['groups'], ['leaf'])
+
+        # cycles and unknown groups are refused
+        self._nest('leaf', ['top'], 400)
+        self._nest('leaf', ['leaf'], 400)
+        self._nest('top', ['nogroup'], 400)
+        for data in ['{"users": 5}', '{"users": null}', '{"users": [[1]]}',
+                     '{"groups": 7}', '{"groups": [""]}', 'null', '"user1"']:
+            resp = self.app.put('/groups/top',
+                                content_type='application/json', data=data)
+            self.assertEqual(resp.status_code, 400)
+
+        # a second path to leaf keeps it in top when the first goes
+        self._nest('top', ['mid', 'other'])
+        self._nest('mid', [])
+        resp = self.app.get('/users/user1/effective-groups/top')
+        self.assertEqual(resp.status_code, 204)
+        resp = self.app.get('/users/user1/effective-groups/mid')
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.app.delete('/groups/other')
+        self.assertEqual(resp.status_code, 200)
+        resp = self.app.get('/users/user1/effective-groups')
+        self.assertEqual(json.loads(resp.data), ['leaf'])
+        resp = self.app.get('/groups/top/subgroups')
+        self.assertEqual(json.loads(resp.data), ['mid'])
+
+        resp = self.app.get('/users/nouser/effective-groups')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_445_nesting_touches(self):
+        """ Make sure nesting changes are logged against the parent group
+        alone, without touching any users """
+        for user in ['user1', 'user2', 'user3']:
+            self._create_user(user)
+        self._add_user_to_group('user1', 'top')
+        self._add_user_to_group('user2', 'leaf')
+        self._add_user_to_group('user3', 'mid')
+        self._nest('mid', ['leaf'])
+        etag = self.app.get('/users/user2').headers['ETag']
+
+        since = json.loads(self.app.get('/changes/').data)['next']
+
+        def changed():
+            data = json.loads(self.app.get('/changes/?since=%d' %
+                                           since).data)
+            return sorted((x['type'], x['id']) for x in data['changes'])
+
+        self._nest('top', ['mid'])
+        self.assertEqual(changed(), [('group', 'top')])
+
+        resp = self.app.put('/groups/top', content_type='application/json',
+                            data='{}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(changed(), [('group', 'top'), ('group', 'top')])
+
+        self.assertEqual(self.app.get('/users/user2').headers['ETag'], etag)
+        resp = self.app.get('/groups/top')
+        self.assertEqual(json.loads(resp.data), ['user1'])
+        resp = self.app.get('/users/user2/effective-groups/top')
+        self.assertEqual(resp.status_code, 204)
+
+    def test_450_membership_check(self):
+        """ Make sure membership checks answer 204 or 404 """
+        self._create_user('user1')
+        self._create_user('user2')
+        self._add_user_to_group('user1', 'group1')
+
+        for index in [False, True]:
+            self.user_app.config['MEMBERSHIP_INDEX'] = index
+
+            resp = self.app.get('/groups/group1/members/user1')
+            self.assertEqual(resp.status_code, 204)
+            resp = self.app.head('/groups/group1/members/user1')
+            self.assertEqual(resp.status_code, 204)
+            resp = self.app.get('/groups/group1/members/user2')
+            self.assertEqual(resp.status_code, 404)
+            resp = self.app.get('/groups/nogroup/members/user1')
+            self.assertEqual(resp.status_code, 404)
+
+            # writes show up straight away
+            resp = self.app.post('/groups/group1/members/user2')
+            self.assertEqual(resp.status_code, 201)
+            resp = self.app.get('/groups/group1/members/user2')
+            self.assertEqual(resp.status_code, 204)
+            resp = self.app.put('/groups/group1',
+                                content_type='application/json',
+                                data='["user1"]')
+            self.assertEqual(resp.status_code, 200)
+            resp = self.app.get('/groups/group1/members/user2')
+            self.assertEqual(resp.status_code, 404)
+
+    def _run_job(self, job):
+        resp = self.app.post('/jobs/', content_type='application/json',
+                             data=json.dumps(job))
+        self.assertEqual(resp.status_code, 202)
+        location = resp.headers['Location']
+
+        for _ in range(100):
+            resp = self.app.get(location)
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data)
+            if data['status'] in ['done', 'failed']:
+                return data
+            time.sleep(0.05)
+
+        self.fail('job did not finish')
+
+    def test_460_bulk_jobs(self):
+        """ Make sure bulk jobs run in chunks and report progress """
+        self.user_app.config['JOBS_CHUNK_SIZE'] = 2
+        worker = self.user_app.extensions['userapi_jobs']
+
+        try:
+            data = self._run_job({
+                'kind': 'upsert_users',
+                'users': [{'userid': 'user%d' % x, 'groups': ['group1']}
+                          for x in range(5)]})
+            self.assertEqual(data['status'], 'done')
+            self.assertEqual(data['total'], 5)
+            self.assertEqual(data['done'], 5)
+            self.assertEqual(data['result'], {'created': 5, 'updated': 0})
+
+            data = self._run_job({'kind': 'replace_members',
+                                  'group': 'group1',
+                                  'users': ['user3', 'user4']})
+            self.assertEqual(data['status'], 'done')
+            self.assertEqual(data['result'], {'added': 0, 'removed': 3})
+            resp = self.app.get('/groups/group1')
+            self.assertEqual(sorted(json.loads(resp.data)),
+                             ['user3', 'user4'])
+
+            data = self._run_job({'kind': 'delete_users',
+                                  'users': ['user3', 'user0', 'nouser']})
+            self.assertEqual(data['result'], {'deleted': 2, 'missing': 1})
+            resp = self.app.get('/users/user3')
+            self.assertEqual(resp.status_code, 404)
+            resp = self.app.get('/groups/group1')
+            self.assertEqual(json.loads(resp.data), ['user4'])
+
+            data = self._run_job({'kind': 'replace_members',
+                                  'group': 'group1',
+                                  'users': ['nouser']})
+            self.assertEqual(data['status'], 'failed')
+            self.assertEqual(data['error'], 'Unknown user nouser')
+        finally:
+            worker.stop()
+
+        resp = self.app.post('/jobs/', content_type='application/json',
+                             data='{"kind": "bogus"}')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.app.get('/jobs/1000')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_465_stale_jobs(self):
+        """ Make sure a restarted process picks up jobs a dead one left
+        queued or running """
+        from userapi.database.model import JobModel
+
+        with self.user_app.app_context():
+            for userid, status, minutes in [('user1', 'running', 10),
+                                            ('user2', 'queued', 10),
+                                            ('user3', 'running', 1)]:
+                job = JobModel('upsert_users', {'users': [{'userid': userid}]})
+                job.status = status
+                job.updated = (datetime.datetime.utcnow() -
+                               datetime.timedelta(minutes=minutes))
+                db.session.add(job)
+            db.session.commit()
+            db.session.remove()
+
+        with open(self.config_path, 'a') as f:
+            f.write('JOBS_AUTOSTART = True\n')
+            f.write('JOBS_STALE_TIMEOUT = 300\n')
+
+        restarted = userapi.cli.create_app(config=self.config_path)
+        db.app = restarted
+        client = restarted.test_client()
+
+        def status(job_id):
+            resp = client.get('/jobs/%d' % job_id)
+            return json.loads(resp.data)['status']
+
+        try:
+            # any request starts the worker
+            deadline = time.time() + 5
+            while time.time() < deadline and (
+                    status(1) != 'done' or status(2) != 'done'):
+                time.sleep(0.05)
+
+            self.assertEqual(status(1), 'done')
+            self.assertEqual(status(2), 'done')
+            self.assertEqual(status(3), 'running')
+            resp = client.get('/users/user1')
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            restarted.extensions['userapi_jobs'].stop()
+
+    def test_470_read_replica(self):
+        """ Make sure reads go to the replica bind and writes don't """
+        replica_path = os.path.join(os.path.dirname(__file__), 'replica.db')
+        with open(self.config_path, 'a') as f:
+            f.write('SQLALCHEMY_BINDS = {"replica": "sqlite:///%s"}\n' %
+                    replica_path)
+            f.write('SQLALCHEMY_POOL_PRE_PING = True\n')
+
+        replica_app = userapi.cli.create_app(config=self.config_path)
+        db.app = replica_app
+        client = replica_app.test_client()
+
+        try:
+            replica = db.get_engine(replica_app, bind='replica')
+            db.metadata.create_all(replica)
+            replica.execute("INSERT INTO users (userid, first_name, "
+                            "last_name) VALUES ('user2', '', '')")
+
+            resp = client.post('/users/user1',
+                               content_type='application/json', data='{}')
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(db.engine.execute(
+                'SELECT userid FROM users').fetchall(), [('user1',)])
+
+            resp = client.get('/users/user1')
+            self.assertEqual(resp.status_code, 404)
+            resp = client.head('/users/user2')
+            self.assertEqual(resp.status_code, 200)
+            resp = client.get('/users/')
+            self.assertEqual(json.loads(resp.data), ['user2'])
+        finally:
+            os.unlink(replica_path)
+
+    def test_480_response_encoding(self):
+        """ Make sure responses are compact, streamed and compressed """
+        self.user_app.config['JSON_STREAM_THRESHOLD'] = 2
+        for user in ['user1', 'user2', 'user3']:
+            self._create_user(user)
+            self._add_user_to_group(user, 'group1')
+
+        resp = self.app.get('/groups/group1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.data, b'["user1","user2","user3"]\n')
+
+        resp = self.app.get('/users/?ids=user1,user2,user3')
+        self.assertEqual(sorted(json.loads(resp.data)),
+                         ['user1', 'user2', 'user3'])
+
+        self.user_app.config['COMPRESS_MIN_SIZE'] = 0
+        for encoding, wbits in [('gzip', 16 + zlib.MAX_WBITS),
+                                ('deflate', zlib.MAX_WBITS)]:
+            for url in ['/groups/group1', '/users/user1']:
+                resp = self.app.get(url,
+                                    headers={'Accept-Encoding': encoding})
+                self.assertEqual(resp.headers['Content-Encoding'], encoding)
+                self.assertTrue('Accept-Encoding' in resp.headers['Vary'])
+                self.assertEqual(
+                    json.loads(zlib.decompress(resp.data, wbits)),
+                    json.loads(self.app.get(url).data))
+
+                # each encoding has its own ETag, and any of them, weak
+                # or strong, matches the version
+                plain = self.app.get(url).headers['ETag']
+                tag = resp.headers['ETag']
+                self.assertEqual(tag, '%s-%s"' % (plain[:-1], encoding))
+                for match in [tag, 'W/' + tag, plain]:
+                    resp = self.app.get(url, headers={
+                        'Accept-Encoding': encoding,
+                        'If-None-Match': match})
+                    self.assertEqual(resp.status_code, 304)
+
+        resp = self.app.get('/users/user1',
+                            headers={'Accept-Encoding': 'identity'})
+        self.assertFalse('Content-Encoding' in resp.headers)
+
+    def test_490_bulk_delete(self):
+        """ Make sure bulk deletes remove users, groups and their links """
+        for user in ['user1', 'user2', 'user3']:
+            self._create_user(user)
+            self._add_user_to_group(user, 'group1')
+        self._add_user_to_group('user1', 'group2')
+        self._add_user_to_group('user1', 'group3')
+        self._nest('group1', ['group2'])
+        self._nest('group2', ['group3'])
+
+        resp = self.app.delete('/users/?ids=user2,nouser,user3')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data),
+                         {'deleted': ['user2', 'user3'],
+                          'missing': ['nouser']})
+        resp = self.app.get('/groups/group1')
+        self.assertEqual(json.loads(resp.data), ['user1'])
+
+        resp = self.app.delete('/groups/?ids=group2')
+        self.assertEqual(json.loads(resp.data),
+                         {'deleted': ['group2'], 'missing': []})
+        resp = self.app.get('/users/user1')
+        self.assertItemsEqual(json.loads(resp.data)['groups'],
+                              ['group1', 'group3'])
+        resp = self.app.get('/groups/group1/subgroups')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.app.get('/users/user1/effective-groups')
+        self.assertItemsEqual(json.loads(resp.data), ['group1', 'group3'])
+
+        resp = self.app.delete('/users/user1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(db.engine.execute(
+            'SELECT count(*) FROM usergroup').scalar(), 0)
+
+        resp = self.app.delete('/users/')
+        self.assertEqual(resp.status_code, 400)
+
+        # database errors fail user and group deletes alike
+        self._create_user('user2')
+        db.engine.execute('DROP TABLE changes')
+        for url in ['/users/?ids=user2', '/users/user2',
+                    '/groups/?ids=group1', '/groups/group1']:
+            resp = self.app.delete(url)
+            self.assertEqual(resp.status_code, 500, url)
+
+    def test_500_upgrade_adds_cascades(self):
+        """ Make sure upgrades rebuild link tables without cascades """
+        db.session.remove()
+        db.engine.execute('DROP TABLE usergroup')
+        for sql in [
+                'CREATE TABLE usergroup ('
+                'user_id INTEGER NOT NULL REFERENCES users (id), '
+                'group_id INTEGER NOT NULL REFERENCES groups (id), '
+                'PRIMARY KEY (user_id, group_id))',
+                "INSERT INTO users (id, userid) VALUES (1, 'user1')",
+                "INSERT INTO groups (id, groupid) VALUES (1, 'group1')",
+                'INSERT INTO usergroup VALUES (1, 1)']:
+            db.engine.execute(sql)
+
+        upgrade(db.engine)
+
+        sql = db.engine.execute("SELECT sql FROM sqlite_master "
+                                "WHERE name = 'usergroup'").scalar()
+        self.assertTrue('ON DELETE CASCADE' in sql)
+
+        db.engine.execute('DELETE FROM users')
+        self.assertEqual(db.engine.execute(
+            'SELECT count(*) FROM usergroup').scalar(), 0)
+
+    def test_505_upgrade_stops_id_reuse(self):
+        """ Make sure upgrades rebuild the users and groups tables so
+        ids are never reused, keeping their rows and memberships """
+        self._create_user('user1')
+        self._create_user('user2')
+        self._add_user_to_group('user2', 'group1')
+        db.session.remove()
+
+        # the tables as they were made before AUTOINCREMENT
+        conn = db.engine.connect()
+        conn.execute('PRAGMA foreign_keys = OFF')
+        conn.execute('PRAGMA legacy_alter_table = ON')
+        for table in ['users', 'groups']:
+            sql = conn.execute(
+                "SELECT sql FROM sqlite_master WHERE name = '%s'" %
+                table).scalar()
+            conn.execute('ALTER TABLE %s RENAME TO %s_old' % (table, table))
+            self.assertTrue('AUTOINCREMENT' in sql)
+            conn.execute(sql.replace('AUTOINCREMENT', ''))
+            conn.execute('INSERT INTO %s SELECT * FROM %s_old' % (
+                table, table))
+            conn.execute('DROP TABLE %s_old' % table)
+        conn.execute('PRAGMA legacy_alter_table = OFF')
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.close()
+
+        upgrade(db.engine)
+
+        for table in ['users', 'groups']:
+            sql = db.engine.execute(
+                "SELECT sql FROM sqlite_master WHERE name = '%s'" %
+                table).scalar()
+            self.assertTrue('AUTOINCREMENT' in sql)
+        self.assertEqual(db.engine.execute(
+            'PRAGMA foreign_keys').scalar(), 1)
+
+        resp = self.app.get('/groups/group1')
+        self.assertEqual(json.loads(resp.data), ['user2'])
+
+        self.app.delete('/users/user2')
+        self._create_user('user3')
+        self.assertEqual(db.engine.execute(
+            "SELECT id FROM users WHERE userid = 'user3'").scalar(), 3)
+
+    def test_510_snapshot(self):
+        """ Make sure a compiled snapshot answers GETs like the database """
+        from userapi.snapshot import compile_snapshot
+
+        snapshot_path = os.path.join(os.path.dirname(__file__),
+                                     'test.snapshot')
+        for user in ['user1', 'user2', 'user3', 'other']:
+            self._create_user(user)
+        self.app.put('/users/user1', content_type='application/json',
+                     data='{"first_name": "Alice", "groups": ["group1"]}')
+        self._add_user_to_group('user2', 'group2')
+        self._add_user_to_group('user3', 'group2')
+        self._add_user_to_group('user3', 'group3')
+        self._nest('group1', ['group2'])
+        self._nest('group2', ['group3'])
+        self.app.post('/groups/empty')
+
+        compile_snapshot(snapshot_path)
+        with open(self.config_path, 'a') as f:
+            f.write('SNAPSHOT_PATH = "%s"\n' % snapshot_path)
+        client = userapi.cli.create_app(
+            config=self.config_path).test_client()
+
+        try:
+            for url in ['/users/user1', '/users/nouser', '/users/',
+                        '/users/?limit=2', '/users/?limit=2&after=user1',
+                        '/users/?prefix=user', '/users/?name=ali',
+                        '/users/?group=group2,group3&match=all',
+                        '/users/?group=group2&prefix=user&limit=1',
+                        '/users/?group=group2&group=group3&limit=1',
+                        '/users/?ids=user1,nouser',
+                        '/users/user3/effective-groups',
+                        '/users/user3/effective-groups/group1',
+                        '/users/user1/effective-groups/group2',
+                        '/groups/group2', '/groups/empty', '/groups/none',
+                        '/groups/?limit=1&after=group1',
+                        '/groups/?ids=group1,group2,none',
+                        '/groups/group1/subgroups',
+                        '/groups/group2/members/user3',
+                        '/groups/group1/members/user3', '/export/']:
+                expected = self.app.get(url)
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, expected.status_code, url)
+                self.assertEqual(resp.headers.get('ETag'),
+                                 expected.headers.get('ETag'), url)
+                self.assertEqual(resp.headers.get('Link'),
+                                 expected.headers.get('Link'), url)
+                self.assertEqual(resp.data, expected.data, url)
+
+            resp = client.get('/users/user1', headers={
+                'If-None-Match': self.app.get('/users/user1').headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+            resp = client.delete('/users/user1')
+            self.assertEqual(resp.status_code, 405)
+
+            # a recompiled snapshot replaces the old one in place
+            resp = self.app.delete('/users/user2')
+            self.assertEqual(resp.status_code, 200)
+            compile_snapshot(snapshot_path)
+            resp = client.get('/users/user2')
+            self.assertEqual(resp.status_code, 404)
+            resp = client.get('/groups/group2')
+            self.assertEqual(json.loads(resp.data), ['user3'])
+
+            # admission limits name the same endpoints as for the database
+            with open(self.config_path, 'a') as f:
+                f.write("RATE_LIMITS = {'users.userslist': (0.01, 1)}\n")
+            client = userapi.cli.create_app(
+                config=self.config_path).test_client()
+            self.assertEqual(client.get('/users/').status_code, 200)
+            self.assertEqual(client.get('/users/').status_code, 429)
+            self.assertEqual(client.get('/users/user1').status_code, 200)
+        finally:
+            os.unlink(snapshot_path)
+
+    def test_520_nss_export(self):
+        """ Make sure nss files are written, then updated incrementally """
+        from userapi.nss import export_nss
+
+        out = os.path.join(os.path.dirname(__file__), 'nss')
+        os.mkdir(out)
+
+        def export():
+            with self.user_app.app_context():
+                return export_nss(out)
+
+        def read(name):
+            with open(os.path.join(out, name)) as f:
+                return f.read().splitlines()
+
+        try:
+            self.app.post('/users/user1', content_type='application/json',
+                          data='{"first_name": "A", "last_name": "B"}')
+            self._create_user('user2')
+            self._add_user_to_group('user1', 'group1')
+            self._add_user_to_group('user2', 'group1')
+
+            res = export()
+            self.assertEqual(res, {'users': 2, 'groups': 1, 'full': True})
+            self.assertEqual(read('passwd'), [
+                'user1:x:100001:100:A B:/home/user1:/bin/sh',
+                'user2:x:100002:100::/home/user2:/bin/sh'])
+            self.assertEqual(read('group'), ['group1:x:100001:user1,user2'])
+
+            # nothing changed, nothing written
+            self.assertEqual(export(),
+                             {'users': 0, 'groups': 0, 'full': False})
+
+            # uids of deleted users are never handed out again
+            self.app.delete('/users/user2')
+            self._create_user('user3')
+            res = export()
+            self.assertEqual(res, {'users': 1, 'groups': 1, 'full': False})
+            self.assertEqual([x.split(':')[:3] for x in read('passwd')],
+                             [['user1', 'x', '100001'],
+                              ['user3', 'x', '100003']])
+            self.assertEqual(read('group'), ['group1:x:100001:user1'])
+
+            self.app.delete('/groups/group1')
+            export()
+            self.assertEqual(read('group'), [])
+
+            # names can't break the format
+            self.app.put('/users/user3', content_type='application/json',
+                         data=json.dumps({'first_name': 'A\nevil:x',
+                                          'last_name': 'B,\x7f'}))
+            self._create_user('bad\nname')
+            export()
+            self.assertEqual(read('passwd'), [
+                'user1:x:100001:100:A B:/home/user1:/bin/sh',
+                'user3:x:100003:100:A evil x B  :/home/user3:/bin/sh'])
+        finally:
+            shutil.rmtree(out)
+
+    def test_530_write_batching(self):
+        """ Make sure concurrent writes share transactions, and each
+        still gets its own result """
+        self._create_user('existing')
+
+        with open(self.config_path, 'a') as f:
+            f.write('WRITE_BATCHING = True\n')
+            f.write('WRITE_BATCH_WINDOW = 0.5\n')
+            f.write('METRICS = True\n')
+
+        batch_app = userapi.cli.create_app(config=self.config_path)
+        db.app = batch_app
+
+        requests = [('post', '/users/user%d' % x, 201) for x in range(5)]
+        requests += [('post', '/users/existing', 409),
+                     ('put', '/users/missing', 404),
+                     ('post', '/groups/group1', 201)]
+        results = {}
+
+        def send(method, url):
+            client = batch_app.test_client()
+            resp = getattr(client, method)(
+                url, content_type='application/json', data='{}')
+            results[(method, url)] = resp.status_code
+
+        threads = [threading.Thread(target=send, args=x[:2])
+                   for x in requests]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for method, url, code in requests:
+                self.assertEqual(results[(method, url)], code)
+
+            client = batch_app.test_client()
+            resp = client.get('/users/')
+            self.assertEqual(json.loads(resp.data), [
+                'existing', 'user0', 'user1', 'user2', 'user3', 'user4'])
+
+            with batch_app.app_context():
+                stats = batch_app.extensions['userapi_writes'].stats()
+            self.assertEqual(stats['writes'], len(requests))
+            self.assertTrue(stats['largest'] > 1)
+            self.assertTrue(stats['batches'] < len(requests))
+
+            resp = client.get('/metrics/')
+            self.assertTrue('userapi_write_batched_total %d.0' %
+                            len(requests) in resp.data)
+        finally:
+            batch_app.extensions['userapi_writes'].stop()
+
+    def test_535_write_batching_cache(self):
+        """ Make sure batched writes invalidate the cache when the batch
+        commits, and a rolled back write doesn't lose the others' """
+        from userapi.cache import get_cache
+        from userapi.database.model import touch
+        from userapi.writes import Rollback, apply_write
+
+        self._create_user('user1')
+        self._create_user('user2')
+
+        with open(self.config_path, 'a') as f:
+            f.write('WRITE_BATCHING = True\n')
+            f.write('WRITE_BATCH_WINDOW = 0.5\n')
+
+        batch_app = userapi.cli.create_app(config=self.config_path)
+        db.app = batch_app
+        client = batch_app.test_client()
+
+        def first_name(userid):
+            resp = client.get('/users/%s' % userid)
+            return json.loads(resp.data)['first_name']
+
+        def read_between():
+            # a reader between the savepoint and the commit still sees,
+            # and caches, the old row
+            reader = threading.Thread(target=first_name, args=('user1',))
+            reader.start()
+            reader.join()
+            return 'read'
+
+        def undone():
+            touch(users=['user2'])
+            raise Rollback('undone')
+
+        def write(fn):
+            with batch_app.app_context():
+                results.append(apply_write(fn))
+
+        def put():
+            client.put('/users/user1', content_type='application/json',
+                       data='{"first_name": "new"}')
+
+        results = []
+        threads = [threading.Thread(target=put),
+                   threading.Thread(target=write, args=(read_between,)),
+                   threading.Thread(target=write, args=(undone,))]
+        try:
+            self.assertEqual(first_name('user1'), '')
+            self.assertEqual(first_name('user2'), '')
+
+            for thread in threads:
+                thread.start()
+                time.sleep(0.1)
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(sorted(results), ['read', 'undone'])
+            self.assertEqual(first_name('user1'), 'new')
+
+            # the rolled back write invalidated nothing
+            with batch_app.app_context():
+                self.assertTrue(('user', 'user2') in get_cache()._data)
+                stats = batch_app.extensions['userapi_writes'].stats()
+            self.assertEqual(stats['batches'], 1)
+        finally:
+            batch_app.extensions['userapi_writes'].stop()
+
+    def test_540_admission_control(self):
+        """ Make sure expensive endpoints are rate and concurrency
+        limited, and everything else is left alone """
+        self._create_user('user1')
+        self._add_user_to_group('user1', 'group1')
+
+        with open(self.config_path, 'a') as f:
+            f.write("RATE_LIMITS = {'users.userslist': (0.01, 2)}\n")
+            f.write("RATE_LIMIT_CLIENT_HEADER = 'X-Forwarded-For'\n")
+            f.write("CONCURRENCY_LIMITS = {'groups.groups': (1, 0)}\n")
+            f.write('METRICS = True\n')
+
+        limited_app = userapi.cli.create_app(config=self.config_path)
+        db.app = limited_app
+        client = limited_app.test_client()
+
+        for _ in range(2):
+            resp = client.get('/users/')
+            self.assertEqual(resp.status_code, 200)
+
+        resp = client.get('/users/')
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '100')
+
+        # other clients have their own buckets, told apart by the entry
+        # the proxy added, not anything the client sent
+        for _ in range(2):
+            resp = client.get('/users/',
+                              headers={'X-Forwarded-For': '10.0.0.1'})
+            self.assertEqual(resp.status_code, 200)
+        resp = client.get('/users/',
+                          headers={'X-Forwarded-For': 'spoof, 10.0.0.1'})
+        self.assertEqual(resp.status_code, 429)
+
+        # the slot is held until the response is closed
+        held = client.get('/groups/group1')
+        self.assertEqual(held.status_code, 200)
+        resp = client.get('/groups/group1', buffered=True)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+
+        # unlimited endpoints are unaffected
+        resp = client.get('/users/user1', buffered=True)
+        self.assertEqual(resp.status_code, 200)
+
+        held.close()
+        resp = client.get('/groups/group1', buffered=True)
+        self.assertEqual(resp.status_code, 200)
+
+        resp = client.get('/metrics/')
+        self.assertTrue('userapi_admission_rejected_total{endpoint='
+                        '"groups.groups",reason="concurrency"} 1.0'
+                        in resp.data)
+        self.assertTrue('userapi_admission_rejected_total{endpoint='
+                        '"users.userslist",reason="rate"} 2.0' in resp.data)
@@ -0,0 +1,207 @@
+# Admission control for expensive endpoints.
+#
+# Listing users or reading a huge group costs far more than a single
+# user lookup, and a client calling them in a loop can tie up every
+# worker thread.  Endpoints named in CONCURRENCY_LIMITS run at most so
+# many requests at once, with a bounded number waiting for a turn; the
+# rest are turned away with a 503 straight away.  Endpoints named in
+# RATE_LIMITS get a token bucket per client, and clients that run theirs
+# dry get a 429.  Both carry a Retry-After, and endpoints not named,
+# like single user lookups, are never held up.
+
+import collections
+import math
+import threading
+import time
+
+from flask import current_app, g, request
+
+
+class ConcurrencyLimiter(object):
+    """ lets limit requests run at once, and up to queue more wait for
+    a turn """
+
+    def __init__(self, limit, queue):
+        self.limit = limit
+        self.queue = queue
+
+        self._cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def acquire(self, timeout):
+        """ take a slot, waiting up to timeout seconds for one
+
+        Returns:
+          True if a slot was taken, and must be released
+        """
+        with self._cond:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue:
+                    self.rejected += 1
+                    return False
+
+                self.waiting += 1
+                self.queued += 1
+                deadline = time.time() + timeout
+                try:
+                    while self.active >= self.limit:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class RateLimiter(object):
+    """ a token bucket per client, refilling at rate tokens a second up
+    to burst.  Only the most recently seen max_clients are tracked. """
+
+    def __init__(self, rate, burst, max_clients):
+        self.rate = float(rate)
+        self.burst = burst
+        self.max_clients = max_clients
+
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+        self.admitted = 0
+        self.rejected = 0
+
+    def take(self, client):
+        """ take a token from the client's bucket
+
+        Returns:
+          0 if one was taken, else seconds until one will be available
+        """
+        now = time.time()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+                self.admitted += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.rejected += 1
+
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+            return wait
+
+
+class Admission(object):
+    """ the limiters for an app's endpoints """
+
+    def __init__(self, config):
+        self.timeout = config['CONCURRENCY_QUEUE_TIMEOUT']
+        self.retry_after = config['ADMISSION_RETRY_AFTER']
+        self.client_header = config['RATE_LIMIT_CLIENT_HEADER']
+        self.proxy_hops = config['RATE_LIMIT_PROXY_HOPS']
+
+        self.concurrency = dict(
+            (endpoint, ConcurrencyLimiter(*limits))
+            for endpoint, limits in config['CONCURRENCY_LIMITS'].items())
+        self.rates = dict(
+            (endpoint, RateLimiter(rate, burst,
+                                   config['RATE_LIMIT_CLIENTS']))
+            for endpoint, (rate, burst) in config['RATE_LIMITS'].items())
+
+    def client(self):
+        if self.client_header and self.client_header in request.headers:
+            # behind proxies, each appends the address it got the request
+            # from, so the entry the outermost trusted proxy added is the
+            # real client.  Anything to its left came from the client.
+            hops = [x.strip() for x in
+                    request.headers[self.client_header].split(',')]
+            if len(hops) >= self.proxy_hops:
+                return hops[-self.proxy_hops]
+
+        return request.remote_addr
+
+    def stats(self):
+        """ per endpoint counts, as dicts """
+        concurrency = dict(
+            (x, {'active': y.active, 'waiting': y.waiting,
+                 'admitted': y.admitted, 'queued': y.queued,
+                 'rejected': y.rejected})
+            for x, y in self.concurrency.items())
+        rates = dict(
+            (x, {'admitted': y.admitted, 'rejected': y.rejected})
+            for x, y in self.rates.items())
+        return {'concurrency': concurrency, 'rate': rates}
+
+
+def _reject(message, code, retry_after):
+    resp = current_app.make_response((message, code))
+    resp.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return resp
+
+
+def _admit():
+    admission = get_admission()
+
+    rate = admission.rates.get(request.endpoint)
+    if rate is not None:
+        wait = rate.take(admission.client())
+        if wait:
+            return _reject('Too many requests', 429, wait)
+
+    limiter = admission.concurrency.get(request.endpoint)
+    if limiter is not None:
+        if not limiter.acquire(admission.timeout):
+            return _reject('Server busy', 503, admission.retry_after)
+        g.admission_slot = limiter
+
+
+def _hand_off(response):
+    # hold the slot until a streamed response has been sent
+    limiter = getattr(g, 'admission_slot', None)
+    if limiter is not None:
+        response.call_on_close(limiter.release)
+        g.admission_slot = None
+
+    return response
+
+
+def _release(exc):
+    # the handler failed before there was a response to hand off to
+    limiter = getattr(g, 'admission_slot', None)
+    if limiter is not None:
+        limiter.release()
+        g.admission_slot = None
+
+
+def init_admission(app):
+    """ apply CONCURRENCY_LIMITS and RATE_LIMITS, if there are any.  This
+    has to be set up before anything else with an after_request, so the
+    response it hands slots to is the one that gets sent """
+    config = app.config
+    if not config['CONCURRENCY_LIMITS'] and not config['RATE_LIMITS']:
+        return
+
+    app.extensions['userapi_admission'] = Admission(config)
+    app.before_request(_admit)
+    app.after_request(_hand_off)
+    app.teardown_request(_release)
+
+
+def get_admission():
+    return current_app.extensions.get('userapi_admission')
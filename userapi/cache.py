@@ -0,0 +1,150 @@
+# In-process read-through cache for user and group lookups
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+from flask.ext.sqlalchemy import SignallingSession
+from sqlalchemy import event
+
+
+class LRUCache(object):
+    """ Bounded, thread-safe LRU cache with a per-entry TTL """
+
+    def __init__(self, size, ttl, stats=True):
+        self.size = size
+        self.ttl = ttl
+        self.count_stats = stats
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+        # bumped on every invalidation, so a load that raced with a
+        # write doesn't put stale data back in the cache
+        self._generation = 0
+
+    def _count(self, hit):
+        if self.count_stats:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get_or_load(self, key, loader):
+        """ return the cached value for key, or call loader to fetch it.
+        None results are not cached. """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                # re-insert to mark as most recently used
+                self._data[key] = entry
+                self._count(True)
+                return entry[1]
+
+            self._count(False)
+            generation = self._generation
+
+        value = loader()
+        if value is None:
+            return value
+
+        with self._lock:
+            if generation == self._generation:
+                self._data.pop(key, None)
+                self._data[key] = (time.time() + self.ttl, value)
+                while len(self._data) > self.size:
+                    self._data.popitem(last=False)
+
+        return value
+
+    def delete(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        return {'entries': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+def init_cache(app):
+    """ set up the cache for an app, if CACHE_SIZE is non-zero """
+    cache = None
+    if app.config['CACHE_SIZE']:
+        cache = LRUCache(app.config['CACHE_SIZE'], app.config['CACHE_TTL'],
+                         stats=app.config['CACHE_STATS'])
+
+    app.extensions['userapi_cache'] = cache
+
+
+def get_cache():
+    return current_app.extensions.get('userapi_cache')
+
+
+def cached(key, loader):
+    """ read through the app cache, if there is one """
+    cache = get_cache()
+    if cache is None:
+        return loader()
+
+    return cache.get_or_load(key, loader)
+
+
+def invalidate(users=(), groups=()):
+    """ drop cached entries for the named users and groups """
+    cache = get_cache()
+    if cache is not None:
+        cache.delete([('user', x) for x in users] +
+                     [('group', x) for x in groups] +
+                     [('members', x) for x in groups])
+
+
+# anything touched (see userapi.database.model.touch) is dropped from
+# the cache once the change is committed.  touch() keeps names per
+# savepoint: a released savepoint passes its names up to the enclosing
+# transaction, one rolled back drops them, and only the outermost commit
+# invalidates anything, since until then readers still see the old rows.
+def _real_transaction(transaction):
+    while transaction.parent is not None and not transaction.nested:
+        transaction = transaction.parent
+    return transaction
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def _after_commit(session):
+    transaction = session.transaction
+    if transaction.parent is not None:
+        # a savepoint, released
+        session.info.setdefault('committed', set()).add(transaction)
+        return
+
+    touched = session.info.get('touched', {}).pop(transaction, None)
+    if touched and has_app_context():
+        invalidate(touched['users'], touched['groups'])
+
+
+@event.listens_for(SignallingSession, 'after_transaction_end')
+def _after_transaction_end(session, transaction):
+    committed = session.info.get('committed', set())
+    released = transaction in committed
+    committed.discard(transaction)
+
+    touched = session.info.get('touched', {}).pop(transaction, None)
+    if not touched or not released:
+        return
+
+    parent = session.info['touched'].setdefault(
+        _real_transaction(transaction.parent),
+        {'users': set(), 'groups': set()})
+    parent['users'].update(touched['users'])
+    parent['groups'].update(touched['groups'])
@@ -4,14 +4,149 @@ import os
 
 from flask import Flask
 
-from userapi.database import db
+from userapi.admission import init_admission
+from userapi.cache import init_cache
+from userapi.compression import init_compression
+from userapi.database import db, configure_engine
+from userapi.jobs import init_jobs
+from userapi.metrics import init_metrics
+from userapi.snapshot import init_snapshot
 from userapi.webapp.users import users_bp
 from userapi.webapp.groups import groups_bp
+from userapi.webapp.export import export_bp
+from userapi.webapp.changes import changes_bp
+from userapi.webapp.jobs import jobs_bp
+from userapi.webapp.metrics import metrics_bp
+from userapi.webapp.snapshot import (snapshot_export_bp, snapshot_groups_bp,
+                                     snapshot_users_bp)
+from userapi.writes import init_writes
 
 
 class DefaultConfig(object):
     BIND = "0.0.0.0"
     PORT = "5000"
+    HOST = "127.0.0.1"
+
+    # worker processes and threads per process for manage.py serve, and
+    # how long a request may run before its worker is restarted
+    SERVER_WORKERS = 4
+    SERVER_THREADS = 4
+    SERVER_TIMEOUT = 60
+
+    # connection pool per process, for server databases; sqlite opens a
+    # connection per session unless SQLALCHEMY_POOL_SIZE is set.  Pre-ping
+    # checks each connection as it is checked out, and replaces it if the
+    # server has closed it.  SQLALCHEMY_ENGINE_OPTIONS is passed on to
+    # create_engine as is.
+    SQLALCHEMY_POOL_SIZE = None
+    SQLALCHEMY_MAX_OVERFLOW = None
+    SQLALCHEMY_POOL_TIMEOUT = None
+    SQLALCHEMY_POOL_RECYCLE = None
+    SQLALCHEMY_POOL_PRE_PING = False
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+
+    # reads made while handling GET and HEAD requests go to this bind,
+    # if it is set, e.g. {'replica': 'postgresql://replica/userapi'}.
+    # Replicas lag, so a client may not see its own write straight away.
+    SQLALCHEMY_BINDS = None
+
+    # set on every new sqlite connection.  WAL lets readers carry on
+    # alongside a writer, and the busy timeout (in ms) makes writers
+    # wait for the lock rather than fail with "database is locked"
+    SQLITE_JOURNAL_MODE = "WAL"
+    SQLITE_SYNCHRONOUS = "NORMAL"
+    SQLITE_BUSY_TIMEOUT = 5000
+
+    # sqlite only enforces foreign keys, and their ON DELETE CASCADE,
+    # when asked to
+    SQLITE_FOREIGN_KEYS = True
+
+    # prepared statements kept per sqlite connection
+    SQLITE_CACHED_STATEMENTS = 100
+
+    # largest page a client can ask for from the list endpoints
+    MAX_PAGE_SIZE = 1000
+
+    # json lists and objects with more items than this are streamed out
+    # in pieces rather than built as one string
+    JSON_STREAM_THRESHOLD = 1000
+
+    # gzip/deflate compression for clients that accept it, for responses
+    # of at least COMPRESS_MIN_SIZE bytes.  COMPRESS_LEVEL of 0 disables it
+    COMPRESS_LEVEL = 6
+    COMPRESS_MIN_SIZE = 500
+
+    # user and group lookup cache.  CACHE_SIZE of 0 disables it; entries
+    # expire after CACHE_TTL seconds, which bounds how stale other
+    # processes sharing the database can get
+    CACHE_SIZE = 10000
+    CACHE_TTL = 5
+    CACHE_STATS = True
+
+    # answer GET /groups/<group>/members/<user> from a cached set of each
+    # group's members, rather than a query per check
+    MEMBERSHIP_INDEX = False
+
+    # longest a GET /changes/?wait= long-poll can block, and how often
+    # it checks for new changes, in seconds
+    CHANGES_MAX_WAIT = 30
+    CHANGES_POLL_INTERVAL = 0.5
+
+    # bulk jobs (POST /jobs/) are applied this many items per
+    # transaction.  A process's job worker starts with its first request
+    # (or with its first job, without JOBS_AUTOSTART), and then checks
+    # for jobs queued elsewhere this often, in seconds
+    JOBS_CHUNK_SIZE = 500
+    JOBS_POLL_INTERVAL = 5
+    JOBS_AUTOSTART = True
+
+    # a running job that records no progress for this many seconds is
+    # taken to have lost its process, and is queued to run again.  This
+    # must be well over the time one chunk takes.
+    JOBS_STALE_TIMEOUT = 300
+
+    # apply writes from concurrent requests together, up to
+    # WRITE_BATCH_MAX of them in one transaction, waiting at most
+    # WRITE_BATCH_WINDOW seconds for others to join the first
+    WRITE_BATCHING = False
+    WRITE_BATCH_WINDOW = 0.005
+    WRITE_BATCH_MAX = 100
+
+    # serve GETs read-only from a snapshot file made with "manage.py
+    # compile_snapshot", instead of from the database.  A new file
+    # renamed over it is picked up without a restart.
+    SNAPSHOT_PATH = None
+
+    # passwd and group files written by "manage.py export_nss".  uids
+    # and gids are the row ids plus these bases, and every user gets the
+    # same primary group, home directory pattern and shell.
+    NSS_UID_BASE = 100000
+    NSS_GID_BASE = 100000
+    NSS_PRIMARY_GID = 100
+    NSS_HOME = "/home/%s"
+    NSS_SHELL = "/bin/sh"
+
+    # limits on expensive endpoints, by endpoint name, such as
+    # 'users.userslist' or 'groups.groups'.  CONCURRENCY_LIMITS maps
+    # each to (requests running at once, requests that may wait for a
+    # turn); waiters give up after CONCURRENCY_QUEUE_TIMEOUT seconds,
+    # and the rest get a 503.  RATE_LIMITS maps each to (requests a
+    # second, burst) per client, over which they get a 429.  Clients are
+    # told by address, or behind RATE_LIMIT_PROXY_HOPS trusted proxies,
+    # by the entry the outermost one added to RATE_LIMIT_CLIENT_HEADER
+    # (e.g. X-Forwarded-For).  Only the last RATE_LIMIT_CLIENTS seen are
+    # tracked.
+    CONCURRENCY_LIMITS = {}
+    CONCURRENCY_QUEUE_TIMEOUT = 1.0
+    RATE_LIMITS = {}
+    RATE_LIMIT_CLIENTS = 10000
+    RATE_LIMIT_CLIENT_HEADER = None
+    RATE_LIMIT_PROXY_HOPS = 1
+    ADMISSION_RETRY_AFTER = 1
+
+    # per-request query counts and timings, as Server-Timing headers and
+    # from /metrics.  Totals are per process.
+    METRICS = False
 
 
 def create_app(config=None):
@@ -19,14 +154,36 @@ def create_app(config=None):
     app = Flask("userapi")
     app.config.from_object("%s.DefaultConfig" % __name__)
 
-    # register our blueprints
-    app.register_blueprint(users_bp, url_prefix='/users')
-    app.register_blueprint(groups_bp, url_prefix='/groups')
-
     # if we passed a config, use it, else defaults
     if config is not None:
         app.config.from_pyfile(os.path.realpath(config))
 
-    db.init_app(app)
+    if app.config['SNAPSHOT_PATH']:
+        # read-only, straight from a compiled snapshot
+        app.register_blueprint(snapshot_users_bp, url_prefix='/users')
+        app.register_blueprint(snapshot_groups_bp, url_prefix='/groups')
+        app.register_blueprint(snapshot_export_bp, url_prefix='/export')
+        init_snapshot(app)
+    else:
+        # register our blueprints
+        app.register_blueprint(users_bp, url_prefix='/users')
+        app.register_blueprint(groups_bp, url_prefix='/groups')
+        app.register_blueprint(export_bp, url_prefix='/export')
+        app.register_blueprint(changes_bp, url_prefix='/changes')
+        app.register_blueprint(jobs_bp, url_prefix='/jobs')
+
+        db.init_app(app)
+        configure_engine(app)
+        init_cache(app)
+        init_jobs(app)
+        init_writes(app)
+
+    # before anything else that changes responses
+    init_admission(app)
+    init_metrics(app)
+    init_compression(app)
+
+    if app.config['METRICS']:
+        app.register_blueprint(metrics_bp, url_prefix='/metrics')
 
     return app
@@ -0,0 +1,63 @@
+# gzip or deflate response compression, as negotiated by the client's
+# Accept-Encoding.  Streamed responses are compressed as they stream.
+
+import zlib
+
+from flask import current_app, request
+
+COMPRESSIBLE = frozenset(['application/json', 'application/x-ndjson',
+                          'text/plain'])
+
+# zlib window bits for each content coding.  16 + asks zlib for a gzip
+# wrapper, and http's "deflate" is the zlib format
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def _compress_stream(chunks, compressor):
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _compress(response):
+    config = current_app.config
+
+    if (response.status_code != 200 or request.method == 'HEAD' or
+            response.mimetype not in COMPRESSIBLE or
+            'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    if encoding is None:
+        return response
+
+    compressor = zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED,
+                                  _WBITS[encoding])
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.iter_encoded(),
+                                             compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compressor.compress(data) + compressor.flush())
+
+    response.headers['Content-Encoding'] = encoding
+
+    # the encoded body is a different representation, with its own tag
+    tag, weak = response.get_etag()
+    if tag is not None:
+        response.set_etag('%s-%s' % (tag, encoding), weak)
+
+    return response
+
+
+def init_compression(app):
+    """ compress responses, unless COMPRESS_LEVEL is 0 """
+    if app.config['COMPRESS_LEVEL']:
+        app.after_request(_compress)
@@ -1,3 +1,126 @@
-from flask.ext.sqlalchemy import SQLAlchemy
+import threading
+from contextlib import contextmanager
 
-db = SQLAlchemy()
+from flask import has_request_context, request
+from flask.ext.sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, exc, select
+
+# requests that only read, and so can be served from a replica
+READ_METHODS = frozenset(['GET', 'HEAD'])
+
+_local = threading.local()
+
+
+class RoutingSession(SignallingSession):
+    """ session that sends reads made while handling a GET or HEAD
+    request to the 'replica' bind, when SQLALCHEMY_BINDS has one """
+
+    def get_bind(self, mapper=None, clause=None):
+        binds = self.app.config['SQLALCHEMY_BINDS'] or {}
+        if ('replica' in binds and has_request_context() and
+                request.method in READ_METHODS):
+            return db.get_engine(self.app, bind='replica')
+
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class UserApiSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(UserApiSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+        if info.drivername == 'sqlite':
+            connect_args = options.setdefault('connect_args', {})
+            connect_args.setdefault('cached_statements',
+                                    app.config['SQLITE_CACHED_STATEMENTS'])
+
+        # anything else create_engine takes, overriding the above
+        options.update(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+
+db = UserApiSQLAlchemy()
+
+
+def get_engines(app):
+    """ the primary engine, then the replica engine if there is one """
+    engines = [db.get_engine(app)]
+    if 'replica' in (app.config['SQLALCHEMY_BINDS'] or {}):
+        engines.append(db.get_engine(app, bind='replica'))
+
+    return engines
+
+
+@contextmanager
+def write_transactions():
+    """ have transactions this thread starts on sqlite take the write
+    lock straight away, and allow savepoints in them """
+    _local.write_transactions = True
+    try:
+        yield
+    finally:
+        _local.write_transactions = False
+
+
+def _ping_connection(connection, branch):
+    """ check a connection is alive as it is checked out, so one the
+    server has dropped gets replaced rather than failing the request """
+    if branch:
+        return
+
+    should_close = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as e:
+        # a dead connection invalidates the whole pool, so retrying
+        # gets a fresh connection
+        if not e.connection_invalidated:
+            raise
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = should_close
+
+
+def configure_engine(app):
+    """ apply per-connection settings from the app config to its engines """
+    for engine in get_engines(app):
+        if app.config['SQLALCHEMY_POOL_PRE_PING']:
+            event.listen(engine, 'engine_connect', _ping_connection)
+
+        if engine.dialect.name == 'sqlite':
+            _configure_sqlite(app, engine)
+
+
+def _configure_sqlite(app, engine):
+    pragmas = ['PRAGMA busy_timeout = %d' %
+               app.config['SQLITE_BUSY_TIMEOUT']]
+    if app.config['SQLITE_FOREIGN_KEYS']:
+        pragmas.append('PRAGMA foreign_keys = ON')
+    for pragma in ['journal_mode', 'synchronous']:
+        value = app.config['SQLITE_%s' % pragma.upper()]
+        if value:
+            pragmas.append('PRAGMA %s = %s' % (pragma, value))
+
+    @event.listens_for(engine, 'connect')
+    def _sqlite_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    # pysqlite begins transactions itself, only just before the first
+    # write, and so neither takes the lock up front nor notices a
+    # SAVEPOINT.  Under write_transactions() it is told to leave them
+    # alone and they are begun here instead.
+    @event.listens_for(engine, 'begin')
+    def _sqlite_begin(conn):
+        if getattr(_local, 'write_transactions', False):
+            conn.connection.connection.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+
+    @event.listens_for(engine, 'checkin')
+    def _sqlite_checkin(dbapi_conn, connection_record):
+        if dbapi_conn is not None and dbapi_conn.isolation_level is None:
+            dbapi_conn.isolation_level = ''
@@ -0,0 +1,107 @@
+# Bring existing databases up to date with the models.  create_all only
+# creates missing tables, so this covers the rest: missing columns and
+# indexes, and tables that need rebuilding.
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from userapi.database import db
+from userapi.database.model import (GroupModel, UserModel, groupclosure,
+                                    groupgroup, usergroup)
+
+
+def _add_missing_columns(conn, inspector):
+    for table in db.metadata.sorted_tables:
+        existing = set(x['name'] for x in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                conn.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    table.name,
+                    CreateColumn(column).compile(dialect=conn.dialect)))
+
+
+def _create_missing_indexes(conn, inspector):
+    for table in db.metadata.sorted_tables:
+        existing = set(x['name'] for x in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(conn)
+
+
+def _table_sql(conn, table):
+    return conn.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' "
+        "AND name = :name"), name=table.name).scalar().upper()
+
+
+def _needs_rebuild(conn, inspector, table):
+    pk = inspector.get_pk_constraint(table.name)['constrained_columns']
+    if set(pk) != set(x.name for x in table.primary_key):
+        return True
+
+    # reflection reports neither ON DELETE nor AUTOINCREMENT, so look
+    # for them in the table's definition.  Other databases are left to
+    # alter their constraints, and never reuse ids anyway.
+    if conn.dialect.name != 'sqlite':
+        return False
+
+    sql = _table_sql(conn, table)
+    if table.kwargs.get('sqlite_autoincrement') and (
+            'AUTOINCREMENT' not in sql):
+        return True
+
+    return (any(x.ondelete for x in table.foreign_keys) and
+            'ON DELETE' not in sql)
+
+
+def _rebuild(conn, inspector, table):
+    """ recreate a table from the model definition, keeping its rows,
+    less any duplicate or dangling ones """
+    old = '%s_old' % table.name
+    columns = ', '.join(x.name for x in table.columns)
+    existing = ' AND '.join('%s IN (SELECT %s FROM %s)' % (
+        x.parent.name, x.column.name, x.column.table.name)
+        for x in table.foreign_keys)
+
+    for index in inspector.get_indexes(table.name):
+        conn.execute('DROP INDEX %s' % index['name'])
+
+    conn.execute('ALTER TABLE %s RENAME TO %s' % (table.name, old))
+    table.create(conn)
+
+    conn.execute(text(
+        'INSERT INTO %s (%s) SELECT DISTINCT %s FROM %s%s' % (
+            table.name, columns, columns, old,
+            ' WHERE %s' % existing if existing else '')))
+    conn.execute('DROP TABLE %s' % old)
+
+
+def upgrade(engine):
+    """ upgrade the database schema in place """
+    db.metadata.create_all(engine)
+
+    with engine.connect() as conn:
+        sqlite = conn.dialect.name == 'sqlite'
+        if sqlite:
+            # tables other tables refer to get rebuilt, so the old copy
+            # must be dropped without cascading, and renamed without
+            # the references following it.  Neither can change inside
+            # a transaction.
+            foreign_keys = conn.execute('PRAGMA foreign_keys').scalar()
+            conn.execute('PRAGMA foreign_keys = OFF')
+            conn.execute('PRAGMA legacy_alter_table = ON')
+
+        try:
+            with conn.begin():
+                inspector = inspect(conn)
+
+                _add_missing_columns(conn, inspector)
+                for table in [UserModel.__table__, GroupModel.__table__,
+                              usergroup, groupgroup, groupclosure]:
+                    if _needs_rebuild(conn, inspector, table):
+                        _rebuild(conn, inspector, table)
+                _create_missing_indexes(conn, inspect(conn))
+        finally:
+            if sqlite:
+                conn.execute('PRAGMA legacy_alter_table = OFF')
+                conn.execute('PRAGMA foreign_keys = %d' % foreign_keys)
@@ -1,47 +1,212 @@
+import datetime
+import json
+
+from six import unichr
+from sqlalchemy import and_, bindparam, func, or_, select
+
 from userapi.database import db
 
+# sqlite caps the number of bound parameters in a statement, so
+# large IN (...) lists get split into chunks of this size
+IN_CHUNK_SIZE = 500
+
+
+def _chunked(items, size=IN_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _unique(items):
+    """ de-duplicate a list of names, preserving order """
+    seen = set()
+    return [x for x in items if not (x in seen or seen.add(x))]
+
+
+def _lookup(model, name_col, names):
+    """ map names to model objects with chunked IN (...) queries """
+    res = {}
+    for chunk in _chunked(names):
+        res.update((getattr(x, name_col.key), x)
+                   for x in model.query.filter(name_col.in_(chunk)))
+    return res
+
+
+def _prefix_clause(column, prefix):
+    """ column starts with prefix, as a range an index can serve """
+    upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+    return and_(column >= prefix, column < upper)
+
+
+def _ids_by_name(name_col, id_col, names):
+    """ map names to row ids with chunked IN (...) queries """
+    res = {}
+    for chunk in _chunked(names):
+        query = select([name_col, id_col]).where(name_col.in_(chunk))
+        res.update((row[0], row[1]) for row in db.session.execute(query))
+    return res
 
-# set up a many-to-many intermediate table
+
+# directory-wide change counter.  Every change stamps the rows it
+# touches with a new serial, which is what the version columns and the
+# ETags built from them hold.
+directory = db.Table('directory',
+                     db.Column('id', db.Integer, primary_key=True),
+                     db.Column('serial', db.Integer, nullable=False))
+
+
+# append-only log of changes, written by touch(), for incremental sync.
+# kind is 'user' or 'group', op is 'update' (which covers creation) or
+# 'delete'.
+changes = db.Table('changes',
+                   db.Column('seq', db.Integer, primary_key=True),
+                   db.Column('kind', db.String(10), nullable=False),
+                   db.Column('name', db.String(50), nullable=False),
+                   db.Column('op', db.String(10), nullable=False),
+                   sqlite_autoincrement=True)
+
+
+# set up a many-to-many intermediate table.  The primary key covers
+# lookups by user, and the reverse index lookups by group.  Rows go with
+# their user or group, so a delete needs no per-row cleanup.
 usergroup = db.Table('usergroup',
                      db.Column('user_id',
                                db.Integer,
-                               db.ForeignKey('users.id')),
+                               db.ForeignKey('users.id',
+                                             ondelete='CASCADE'),
+                               primary_key=True),
                      db.Column('group_id',
                                db.Integer,
-                               db.ForeignKey('groups.id')))
+                               db.ForeignKey('groups.id',
+                                             ondelete='CASCADE'),
+                               primary_key=True),
+                     db.Index('ix_usergroup_group_user',
+                              'group_id', 'user_id'))
+
+
+# group nesting.  Members of a child group are effectively members of
+# the parent, and of every group above it.
+groupgroup = db.Table('groupgroup',
+                      db.Column('parent_id',
+                                db.Integer,
+                                db.ForeignKey('groups.id',
+                                              ondelete='CASCADE'),
+                                primary_key=True),
+                      db.Column('child_id',
+                                db.Integer,
+                                db.ForeignKey('groups.id',
+                                              ondelete='CASCADE'),
+                                primary_key=True),
+                      db.Index('ix_groupgroup_child_parent',
+                               'child_id', 'parent_id'))
+
+
+# transitive closure of groupgroup, kept up to date as nesting changes.
+# There is a row for every group nested anywhere below another, with
+# the number of distinct nesting paths between them, so removing one
+# path can tell whether another remains.
+groupclosure = db.Table('groupclosure',
+                        db.Column('ancestor_id',
+                                  db.Integer,
+                                  db.ForeignKey('groups.id',
+                                                ondelete='CASCADE'),
+                                  primary_key=True),
+                        db.Column('descendant_id',
+                                  db.Integer,
+                                  db.ForeignKey('groups.id',
+                                                ondelete='CASCADE'),
+                                  primary_key=True),
+                        db.Column('paths', db.Integer, nullable=False),
+                        db.Index('ix_groupclosure_descendant_ancestor',
+                                 'descendant_id', 'ancestor_id'))
+
+
+def _closure_paths(id_col, other_col, group_id):
+    """ (id, paths) for the groups above or below group_id, including
+    group_id itself """
+    query = select([id_col, groupclosure.c.paths]).where(
+        other_col == group_id)
+    return [(group_id, 1)] + [tuple(x) for x in db.session.execute(query)]
+
+
+def _adjust_closure(parent_id, child_id, sign):
+    """ add (sign 1) or remove (sign -1) the paths that go through a
+    parent -> child nesting """
+    ancestors = _closure_paths(groupclosure.c.ancestor_id,
+                               groupclosure.c.descendant_id, parent_id)
+    descendants = _closure_paths(groupclosure.c.descendant_id,
+                                 groupclosure.c.ancestor_id, child_id)
+
+    deltas = dict(((a, d), sign * a_paths * d_paths)
+                  for a, a_paths in ancestors
+                  for d, d_paths in descendants)
+
+    current = {}
+    for a_chunk in _chunked(x[0] for x in ancestors):
+        for d_chunk in _chunked(x[0] for x in descendants):
+            query = select([groupclosure]).where(and_(
+                groupclosure.c.ancestor_id.in_(a_chunk),
+                groupclosure.c.descendant_id.in_(d_chunk)))
+            current.update(((x.ancestor_id, x.descendant_id), x.paths)
+                           for x in db.session.execute(query))
+
+    inserts, updates, deletes = [], [], []
+    for (a, d), delta in deltas.items():
+        paths = current.get((a, d), 0) + delta
+        row = {'_a': a, '_d': d, '_paths': paths}
+        if (a, d) not in current:
+            inserts.append({'ancestor_id': a, 'descendant_id': d,
+                            'paths': paths})
+        elif paths:
+            updates.append(row)
+        else:
+            deletes.append(row)
+
+    pair = and_(groupclosure.c.ancestor_id == bindparam('_a'),
+                groupclosure.c.descendant_id == bindparam('_d'))
+    if inserts:
+        db.session.execute(groupclosure.insert(), inserts)
+    if updates:
+        db.session.execute(groupclosure.update().where(pair).values(
+            paths=bindparam('_paths')), updates)
+    if deletes:
+        db.session.execute(groupclosure.delete().where(pair), deletes)
 
 
 class UserModel(db.Model):
     """ SQLAlchemy user model """
     __tablename__ = 'users'
+    # ids are exported as uids (see userapi.nss), so must never be
+    # handed out again after a delete
+    __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
     userid = db.Column(db.String(50), unique=True, nullable=False)
     first_name = db.Column(db.String(50))
     last_name = db.Column(db.String(50))
+    version = db.Column(db.Integer, nullable=False, default=0,
+                        server_default='0', index=True)
 
     def __init__(self, userid, first_name='', last_name=''):
         self.userid = userid
         self.first_name = first_name
         self.last_name = last_name
 
-    # If a user is created with group membership, find the group
-    # or create it automatically.  This could as easily fail if
-    # the group doesn't exist.
-    def _get_or_create_group(self, group):
-        res = GroupModel.query.filter_by(groupid=group).first()
-        if not res:
-            res = GroupModel(group)
-        return res
-
     def _get_groups(self):
         return [x.groupid for x in self.groups_obj]
 
+    # If a user is created with group membership, find the group
+    # or create it automatically.  This could as easily fail if
+    # the group doesn't exist.
     def _set_groups(self, groups):
-        while(self.groups_obj):
-            del self.groups_obj[0]
+        groups = _unique(groups)
+        current = dict((x.groupid, x) for x in self.groups_obj)
+        found = _lookup(GroupModel, GroupModel.groupid,
+                        [x for x in groups if x not in current])
 
-        for group in groups:
-            self.groups_obj.append(self._get_or_create_group(group))
+        # replacing the collection wholesale lets sqlalchemy diff it,
+        # so only the added and removed usergroup rows get written
+        self.groups_obj = [current.get(x) or found.get(x) or GroupModel(x)
+                           for x in groups]
 
     # make a synthetic property that looks and sets like a
     # list of group names
@@ -50,41 +215,684 @@ class UserModel(db.Model):
     def __repr__(self):
         return '<User: %r>' % self.userid
 
+    @classmethod
+    def upsert_many(cls, records):
+        """ create or update a batch of users using set-based queries
+
+        records is a list of dicts with a unique 'userid' key and optional
+        'first_name', 'last_name' and 'groups' keys.  As with a PUT, only
+        the keys present are updated, and a 'groups' key replaces the
+        existing membership.  Missing groups are created.  The session is
+        not committed.
+
+        Returns:
+          dict of userid to 'created' or 'updated'
+        """
+        users = cls.__table__
+        groups = GroupModel.__table__
+
+        existing = {}
+        for chunk in _chunked(r['userid'] for r in records):
+            query = select([users.c.id, users.c.userid,
+                            users.c.first_name, users.c.last_name]).where(
+                users.c.userid.in_(chunk))
+            existing.update((row.userid, row)
+                            for row in db.session.execute(query))
+
+        # resolve every referenced group at once, creating the missing ones
+        group_names = set()
+        for record in records:
+            group_names.update(record.get('groups', []))
+
+        group_ids = _ids_by_name(groups.c.groupid, groups.c.id, group_names)
+        missing = group_names.difference(group_ids)
+        if missing:
+            db.session.execute(groups.insert(),
+                               [{'groupid': x} for x in missing])
+            group_ids.update(_ids_by_name(groups.c.groupid, groups.c.id,
+                                          missing))
+
+        new = [r for r in records if r['userid'] not in existing]
+        if new:
+            db.session.execute(users.insert(), [
+                {'userid': r['userid'],
+                 'first_name': r.get('first_name', ''),
+                 'last_name': r.get('last_name', '')} for r in new])
+
+        changed = [r for r in records if r['userid'] in existing and
+                   ('first_name' in r or 'last_name' in r)]
+        if changed:
+            db.session.execute(
+                users.update().where(users.c.id == bindparam('_id')).values(
+                    first_name=bindparam('_first_name'),
+                    last_name=bindparam('_last_name')),
+                [{'_id': existing[r['userid']].id,
+                  '_first_name': r.get('first_name',
+                                       existing[r['userid']].first_name),
+                  '_last_name': r.get('last_name',
+                                      existing[r['userid']].last_name)}
+                 for r in changed])
+
+        # replace membership for records that carry a group list
+        regrouped = [r for r in records if 'groups' in r]
+        user_ids = dict((k, v.id) for k, v in existing.items())
+        user_ids.update(_ids_by_name(users.c.userid, users.c.id,
+                                     [r['userid'] for r in new]))
+
+        current = {}
+        stale = [user_ids[r['userid']] for r in regrouped
+                 if r['userid'] in existing]
+        for chunk in _chunked(stale):
+            query = select([usergroup.c.user_id, groups.c.groupid])
+            query = query.select_from(
+                groups.join(usergroup, usergroup.c.group_id == groups.c.id)
+            ).where(usergroup.c.user_id.in_(chunk))
+            for row in db.session.execute(query):
+                current.setdefault(row.user_id, set()).add(row.groupid)
+
+            db.session.execute(
+                usergroup.delete().where(usergroup.c.user_id.in_(chunk)))
+
+        # only groups that gained or lost a member have changed
+        group_names = set()
+        for r in regrouped:
+            group_names.update(current.get(
+                user_ids[r['userid']], set()).symmetric_difference(
+                r['groups']))
+
+        links = [{'user_id': user_ids[r['userid']],
+                  'group_id': group_ids[group]}
+                 for r in regrouped for group in _unique(r['groups'])]
+        if links:
+            db.session.execute(usergroup.insert(), links)
+
+        touch(users=[r['userid'] for r in records], groups=group_names)
+
+        return dict((r['userid'],
+                     'updated' if r['userid'] in existing else 'created')
+                    for r in records)
+
+
+# case-insensitive name searches
+db.Index('ix_users_first_name_lower', func.lower(UserModel.first_name))
+db.Index('ix_users_last_name_lower', func.lower(UserModel.last_name))
+
 
 class GroupModel(db.Model):
     """ SQLAlchemy group model """
     __tablename__ = 'groups'
+    __table_args__ = {'sqlite_autoincrement': True}
     id = db.Column(db.Integer, primary_key=True)
     groupid = db.Column(db.String(50), unique=True, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0,
+                        server_default='0', index=True)
 
     # set up the m-t-m relationship
     users_obj = db.relationship('UserModel', secondary=usergroup,
-                                backref=db.backref('groups_obj'))
+                                passive_deletes=True,
+                                backref=db.backref('groups_obj',
+                                                   passive_deletes=True))
 
     def __init__(self, groupid):
         self.groupid = groupid
 
-    # unlike the user synthetic property, we'll raise if we try
-    # and add a non-existent user to the group membership list
-    def _get_user(self, user):
-        res = UserModel.query.filter_by(userid=user).first()
-        if not res:
-            raise ValueError('Unknown user %s' % user)
-        return res
-
     def _get_users(self):
         return [x.userid for x in self.users_obj]
 
+    # unlike the user synthetic property, we'll raise if we try
+    # and add a non-existent user to the group membership list
     def _set_users(self, users):
-        while(self.users_obj):
-            del self.users_obj[0]
+        users = _unique(users)
+        current = dict((x.userid, x) for x in self.users_obj)
+        found = _lookup(UserModel, UserModel.userid,
+                        [x for x in users if x not in current])
 
         for user in users:
-            self.users_obj.append(self._get_user(user))
+            if user not in current and user not in found:
+                raise ValueError('Unknown user %s' % user)
+
+        self.users_obj = [current.get(x) or found[x] for x in users]
 
     # synthetic property that looks like a list of users in
     # the group.
     users = property(_get_users, _set_users)
 
+    def _get_subgroups(self):
+        query = select([GroupModel.groupid]).select_from(
+            groupgroup.join(GroupModel.__table__,
+                            GroupModel.id == groupgroup.c.child_id)).where(
+            groupgroup.c.parent_id == self.id).order_by(GroupModel.groupid)
+        return [x.groupid for x in db.session.execute(query)]
+
+    def _link(self, child_id, child):
+        # nesting a group inside itself, or inside anything below it,
+        # would make a cycle
+        cycle = select([groupclosure.c.paths]).where(and_(
+            groupclosure.c.ancestor_id == child_id,
+            groupclosure.c.descendant_id == self.id))
+        if child_id == self.id or db.session.execute(cycle).first():
+            raise ValueError('Nesting %s in %s makes a cycle' %
+                             (child, self.groupid))
+
+        _adjust_closure(self.id, child_id, 1)
+        db.session.execute(groupgroup.insert().values(
+            parent_id=self.id, child_id=child_id))
+
+    def _unlink(self, child_id):
+        _adjust_closure(self.id, child_id, -1)
+        db.session.execute(groupgroup.delete().where(and_(
+            groupgroup.c.parent_id == self.id,
+            groupgroup.c.child_id == child_id)))
+
+    # nested groups also raise on unknown names, and on cycles
+    def _set_subgroups(self, groups):
+        groups = _unique(groups)
+        db.session.flush()
+
+        current = _ids_by_name(GroupModel.groupid, GroupModel.id,
+                               self._get_subgroups())
+        found = _ids_by_name(GroupModel.groupid, GroupModel.id,
+                             [x for x in groups if x not in current])
+
+        for group in groups:
+            if group not in current and group not in found:
+                raise ValueError('Unknown group %s' % group)
+
+        for group, child_id in current.items():
+            if group not in groups:
+                self._unlink(child_id)
+
+        for group, child_id in found.items():
+            self._link(child_id, group)
+
+    # synthetic property that looks like a list of the groups nested
+    # directly in this one
+    subgroups = property(_get_subgroups, _set_subgroups)
+
+    def unnest(self):
+        """ remove this group from the nesting hierarchy, ahead of
+        deleting it
+
+        Returns:
+          list of the groupids it was nested in
+        """
+        for child_id, in db.session.execute(select(
+                [groupgroup.c.child_id]).where(
+                groupgroup.c.parent_id == self.id)).fetchall():
+            self._unlink(child_id)
+
+        parents = GroupModel.query.join(
+            groupgroup, groupgroup.c.parent_id == GroupModel.id).filter(
+            groupgroup.c.child_id == self.id).all()
+        for parent in parents:
+            parent._unlink(self.id)
+
+        return [x.groupid for x in parents]
+
+    # single membership changes go straight to the usergroup table, so
+    # they don't need to load the (possibly huge) member list
+    def _member_clause(self, user_id):
+        return and_(usergroup.c.group_id == self.id,
+                    usergroup.c.user_id == user_id)
+
+    def has_member(self, user_id):
+        """ check whether a user row id is a direct member """
+        query = select([usergroup.c.user_id]).where(
+            self._member_clause(user_id)).limit(1)
+        return db.session.execute(query).first() is not None
+
+    def add_member(self, user_id):
+        """ add a user row id to the group, returning False if the
+        user is already a member """
+        if self.has_member(user_id):
+            return False
+
+        db.session.execute(usergroup.insert().values(
+            user_id=user_id, group_id=self.id))
+        return True
+
+    def remove_member(self, user_id):
+        """ remove a user row id from the group, returning False if the
+        user was not a member """
+        res = db.session.execute(
+            usergroup.delete().where(self._member_clause(user_id)))
+        return res.rowcount > 0
+
     def __repr__(self):
         return '<Group: %r>' % self.groupid
+
+
+def _user_records(query):
+    """ fold rows of (userid, first_name, last_name, groupid), ordered
+    by userid, into user records """
+    record = None
+    for row in query:
+        if record is None or record['userid'] != row.userid:
+            if record is not None:
+                yield record
+
+            record = {'userid': row.userid,
+                      'first_name': row.first_name,
+                      'last_name': row.last_name,
+                      'groups': []}
+
+        if row.groupid is not None:
+            record['groups'].append(row.groupid)
+
+    if record is not None:
+        yield record
+
+
+def _user_records_query():
+    users = UserModel.__table__
+    groups = GroupModel.__table__
+
+    return select([users.c.userid, users.c.first_name, users.c.last_name,
+                   users.c.version, groups.c.groupid]).select_from(
+        users.outerjoin(usergroup, usergroup.c.user_id == users.c.id)
+        .outerjoin(groups, groups.c.id == usergroup.c.group_id)).order_by(
+        users.c.userid, groups.c.groupid)
+
+
+def iter_users():
+    """ yield every user record, with its groups, in userid order
+
+    This is a single joined query read off a streaming cursor, so
+    memory use doesn't grow with the size of the directory.
+    """
+    query = _user_records_query().execution_options(stream_results=True)
+    return _user_records(db.session.execute(query))
+
+
+def get_user(userid):
+    """ fetch one user record, with its groups, in a single query
+
+    Returns:
+      tuple of the user version and a dict of userid, first_name,
+      last_name and groups, or None
+    """
+    query = _user_records_query().where(
+        UserModel.__table__.c.userid == userid)
+
+    rows = db.session.execute(query).fetchall()
+    if not rows:
+        return None
+
+    return rows[0].version, next(_user_records(rows))
+
+
+def get_group_members(groupid):
+    """ list the members of a group in a single query
+
+    Returns:
+      tuple of the group version and the list of userids, or None if
+      the group does not exist
+    """
+    users = UserModel.__table__
+    groups = GroupModel.__table__
+
+    query = select([groups.c.version, users.c.userid]).select_from(
+        groups.outerjoin(usergroup, usergroup.c.group_id == groups.c.id)
+        .outerjoin(users, users.c.id == usergroup.c.user_id)).where(
+        groups.c.groupid == groupid).order_by(users.c.userid)
+
+    rows = db.session.execute(query).fetchall()
+    if not rows:
+        return None
+
+    return rows[0].version, [x.userid for x in rows if x.userid is not None]
+
+
+def get_users(userids):
+    """ fetch many user records, with their groups, with one IN (...)
+    query per chunk of names
+
+    Returns:
+      dict of userid to user record, leaving out unknown userids
+    """
+    res = {}
+    for chunk in _chunked(set(userids)):
+        query = _user_records_query().where(
+            UserModel.__table__.c.userid.in_(chunk))
+        res.update((x['userid'], x)
+                   for x in _user_records(db.session.execute(query)))
+    return res
+
+
+def get_groups_members(groupids):
+    """ list the members of many groups, with one IN (...) query per
+    chunk of names
+
+    Returns:
+      dict of groupid to list of userids, leaving out unknown groupids
+    """
+    users = UserModel.__table__
+    groups = GroupModel.__table__
+
+    res = {}
+    for chunk in _chunked(set(groupids)):
+        query = select([groups.c.groupid, users.c.userid]).select_from(
+            groups.outerjoin(usergroup, usergroup.c.group_id == groups.c.id)
+            .outerjoin(users, users.c.id == usergroup.c.user_id)).where(
+            groups.c.groupid.in_(chunk)).order_by(
+            groups.c.groupid, users.c.userid)
+
+        for row in db.session.execute(query):
+            members = res.setdefault(row.groupid, [])
+            if row.userid is not None:
+                members.append(row.userid)
+    return res
+
+
+def user_filters(prefix=None, name=None, groups=None, match_all=False):
+    """ build where clauses for a filtered user listing
+
+    prefix matches the start of the userid, and name matches the start of
+    the first or last name, ignoring case.  Both are index ranges.  groups
+    is a list of groupids, of which users must be in any, or all if
+    match_all is set.
+
+    Returns:
+      list of clauses to apply to a query on the users table
+    """
+    users = UserModel.__table__
+    groups_t = GroupModel.__table__
+    clauses = []
+
+    if prefix:
+        clauses.append(_prefix_clause(users.c.userid, prefix))
+
+    if name:
+        name = name.lower()
+        clauses.append(or_(
+            _prefix_clause(func.lower(users.c.first_name), name),
+            _prefix_clause(func.lower(users.c.last_name), name)))
+
+    if groups:
+        groups = _unique(groups)
+        members = select([usergroup.c.user_id]).select_from(
+            usergroup.join(groups_t, groups_t.c.id == usergroup.c.group_id)
+        ).where(groups_t.c.groupid.in_(groups))
+
+        if match_all:
+            members = members.group_by(usergroup.c.user_id).having(
+                func.count() == len(groups))
+
+        clauses.append(users.c.id.in_(members))
+
+    return clauses
+
+
+def is_member(userid, groupid):
+    """ is the user directly in the group?  A single-row key lookup. """
+    users = UserModel.__table__
+    groups = GroupModel.__table__
+
+    query = select([usergroup.c.user_id]).select_from(
+        usergroup.join(users, users.c.id == usergroup.c.user_id)
+        .join(groups, groups.c.id == usergroup.c.group_id)).where(and_(
+            users.c.userid == userid, groups.c.groupid == groupid)).limit(1)
+
+    return db.session.execute(query).first() is not None
+
+
+def get_effective_groups(userid):
+    """ list the groups a user is in, directly or through nesting, from
+    the usergroup table and the precomputed closure
+
+    Returns:
+      sorted list of groupids, or None if the user does not exist
+    """
+    users = UserModel.__table__
+    groups = GroupModel.__table__
+
+    user_id = db.session.execute(select([users.c.id]).where(
+        users.c.userid == userid)).scalar()
+    if user_id is None:
+        return None
+
+    direct = select([usergroup.c.group_id]).where(
+        usergroup.c.user_id == user_id)
+    nested = select([groupclosure.c.ancestor_id]).select_from(
+        groupclosure.join(usergroup, usergroup.c.group_id ==
+                          groupclosure.c.descendant_id)).where(
+        usergroup.c.user_id == user_id)
+
+    query = select([groups.c.groupid]).where(
+        groups.c.id.in_(direct.union(nested))).order_by(groups.c.groupid)
+    return [x.groupid for x in db.session.execute(query)]
+
+
+def is_effective_member(userid, groupid):
+    """ is the user in the group, directly or through nesting?  This is a
+    walk of the user's direct groups, probing the closure by key. """
+    users = UserModel.__table__
+    groups = GroupModel.__table__
+
+    group_id = select([groups.c.id]).where(
+        groups.c.groupid == groupid).as_scalar()
+
+    nested = and_(groupclosure.c.descendant_id == usergroup.c.group_id,
+                  groupclosure.c.ancestor_id == group_id)
+    member = or_(usergroup.c.group_id == group_id,
+                 groupclosure.c.ancestor_id.isnot(None))
+
+    query = select([usergroup.c.group_id]).select_from(
+        usergroup.join(users, users.c.id == usergroup.c.user_id)
+        .outerjoin(groupclosure, nested)).where(and_(
+            users.c.userid == userid, member)).limit(1)
+
+    return db.session.execute(query).first() is not None
+
+
+def get_user_version(userid):
+    return db.session.execute(
+        select([UserModel.__table__.c.version]).where(
+            UserModel.__table__.c.userid == userid)).scalar()
+
+
+def get_group_version(groupid):
+    return db.session.execute(
+        select([GroupModel.__table__.c.version]).where(
+            GroupModel.__table__.c.groupid == groupid)).scalar()
+
+
+def current_serial():
+    """ the directory-wide change counter """
+    return db.session.execute(select([directory.c.serial])).scalar() or 0
+
+
+def _next_serial():
+    res = db.session.execute(
+        directory.update().values(serial=directory.c.serial + 1))
+    if res.rowcount == 0:
+        db.session.execute(directory.insert().values(id=1, serial=1))
+
+    return current_serial()
+
+
+def touch(users=(), groups=(), deleted_users=(), deleted_groups=()):
+    """ record a change to the named users and groups
+
+    Call this in the same transaction as the change.  It bumps the
+    directory serial and stamps the named rows with it, and appends the
+    change to the change log.  The names are also kept in the session
+    info under 'touched', by transaction, so they can be acted on once
+    the change commits.
+
+    A user is touched when its fields or its group list change, and a
+    group when its member list changes.  Users and groups that are being
+    removed go in deleted_users and deleted_groups.
+
+    Returns:
+      the new directory serial
+    """
+    users = set(users).difference(deleted_users)
+    groups = set(groups).difference(deleted_groups)
+
+    # pending ORM changes need to be in the database before the updates
+    db.session.flush()
+    serial = _next_serial()
+
+    for table, col, names in [
+            (UserModel.__table__, 'userid', users),
+            (GroupModel.__table__, 'groupid', groups)]:
+        for chunk in _chunked(names):
+            db.session.execute(table.update().where(
+                table.c[col].in_(chunk)).values(version=serial))
+
+    log = [{'kind': kind, 'name': name, 'op': op}
+           for kind, op, names in [('user', 'update', users),
+                                   ('group', 'update', groups),
+                                   ('user', 'delete', deleted_users),
+                                   ('group', 'delete', deleted_groups)]
+           for name in sorted(names)]
+    if log:
+        db.session.execute(changes.insert(), log)
+
+    # savepoints keep their own names, so rolling one back only drops
+    # what was touched inside it
+    transaction = db.session().transaction
+    while transaction.parent is not None and not transaction.nested:
+        transaction = transaction.parent
+
+    touched = db.session.info.setdefault('touched', {}).setdefault(
+        transaction, {'users': set(), 'groups': set()})
+    touched['users'].update(users, deleted_users)
+    touched['groups'].update(groups, deleted_groups)
+
+    return serial
+
+
+def get_changes(since, limit):
+    """ list change log entries after the since sequence number
+
+    Returns:
+      list of dicts of seq, type, id and op, in sequence order
+    """
+    query = select([changes]).where(changes.c.seq > since).order_by(
+        changes.c.seq).limit(limit)
+
+    return [{'seq': x.seq, 'type': x.kind, 'id': x.name, 'op': x.op}
+            for x in db.session.execute(query)]
+
+
+def last_change():
+    """ the sequence number of the latest change, or 0 """
+    return db.session.execute(select([func.max(changes.c.seq)])).scalar() or 0
+
+
+def delete_users(userids):
+    """ delete users and their memberships with one set-based statement
+    per table, recording the change.  The session is not committed.
+
+    Returns:
+      list of the userids that existed, and were deleted
+    """
+    users = UserModel.__table__
+    groups = GroupModel.__table__
+
+    userids = _unique(userids)
+    found = _ids_by_name(users.c.userid, users.c.id, userids)
+
+    affected = set()
+    for chunk in _chunked(found.values()):
+        query = select([groups.c.groupid]).select_from(
+            groups.join(usergroup, usergroup.c.group_id == groups.c.id)
+        ).where(usergroup.c.user_id.in_(chunk))
+        affected.update(x.groupid for x in db.session.execute(query))
+
+        db.session.execute(
+            usergroup.delete().where(usergroup.c.user_id.in_(chunk)))
+        db.session.execute(users.delete().where(users.c.id.in_(chunk)))
+
+    deleted = [x for x in userids if x in found]
+    if deleted:
+        touch(groups=affected, deleted_users=deleted)
+
+    return deleted
+
+
+def delete_groups(groupids):
+    """ delete groups, taking them out of the nesting hierarchy, with
+    set-based statements for their memberships.  The session is not
+    committed.
+
+    Returns:
+      list of the groupids that existed, and were deleted
+    """
+    users = UserModel.__table__
+    groups = GroupModel.__table__
+
+    groupids = _unique(groupids)
+    found = _lookup(GroupModel, GroupModel.groupid, groupids)
+
+    parents = set()
+    for group in found.values():
+        parents.update(group.unnest())
+
+    members = set()
+    for chunk in _chunked(x.id for x in found.values()):
+        query = select([users.c.userid]).select_from(
+            users.join(usergroup, usergroup.c.user_id == users.c.id)
+        ).where(usergroup.c.group_id.in_(chunk))
+        members.update(x.userid for x in db.session.execute(query))
+
+        db.session.execute(
+            usergroup.delete().where(usergroup.c.group_id.in_(chunk)))
+        db.session.execute(groups.delete().where(groups.c.id.in_(chunk)))
+
+    for group in found.values():
+        db.session.expunge(group)
+
+    deleted = [x for x in groupids if x in found]
+    if deleted:
+        touch(users=members, groups=parents, deleted_groups=deleted)
+
+    return deleted
+
+
+class JobModel(db.Model):
+    """ SQLAlchemy bulk job model.  Jobs are kept in the database so any
+    process can report on them, see userapi.jobs """
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    payload = db.Column(db.Text, nullable=False)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created = db.Column(db.DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+    updated = db.Column(db.DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+
+    def __init__(self, kind, payload):
+        self.kind = kind
+        self.payload = json.dumps(payload)
+
+    def __repr__(self):
+        return '<Job: %r %r>' % (self.id, self.kind)
+
+
+def get_job(job_id):
+    """ fetch the state of a bulk job
+
+    Returns:
+      dict of the job's state, or None if there is no such job
+    """
+    job = JobModel.query.get(job_id)
+    if job is None:
+        return None
+
+    return {'id': job.id,
+            'kind': job.kind,
+            'status': job.status,
+            'total': job.total,
+            'done': job.done,
+            'result': json.loads(job.result) if job.result else None,
+            'error': job.error,
+            'created': job.created.isoformat(),
+            'updated': job.updated.isoformat()}
@@ -0,0 +1,275 @@
+# Background execution of large bulk operations.
+#
+# A bulk job is queued in the jobs table, and a worker thread in the
+# process that took it runs it in chunks of JOBS_CHUNK_SIZE items, one
+# transaction per chunk, so other requests get the write lock in
+# between.  Progress is committed along with each chunk.  A job that
+# fails part way keeps the chunks it finished; every job kind is safe
+# to resubmit.  That includes jobs whose process died while running
+# them: a running job that hasn't recorded progress for
+# JOBS_STALE_TIMEOUT seconds goes back in the queue.
+
+import datetime
+import json
+import logging
+import threading
+
+from flask import current_app
+from sqlalchemy import and_, select
+
+from userapi.database import db
+from userapi.database.model import (GroupModel, JobModel, UserModel,
+                                    _chunked, _ids_by_name, _unique,
+                                    delete_users, touch, usergroup)
+
+LOG = logging.getLogger(__name__)
+
+
+def _replace_members(payload, result, size):
+    """ set the members of payload['group'] to payload['users'] """
+    users = UserModel.__table__
+    groupid = payload['group']
+
+    group = GroupModel.query.filter_by(groupid=groupid).first()
+    if group is None:
+        raise ValueError('Unknown group %s' % groupid)
+    group_id = group.id
+
+    wanted = _unique(payload['users'])
+    found = _ids_by_name(users.c.userid, users.c.id, wanted)
+    for user in wanted:
+        if user not in found:
+            raise ValueError('Unknown user %s' % user)
+
+    query = select([users.c.userid, users.c.id]).select_from(
+        usergroup.join(users, users.c.id == usergroup.c.user_id)).where(
+        usergroup.c.group_id == group_id)
+    current = dict((row.userid, row.id) for row in db.session.execute(query))
+
+    removed = [x for x in current if x not in found]
+    added = [x for x in wanted if x not in current]
+    result.update(added=len(added), removed=len(removed))
+
+    done = 0
+    yield done, len(removed) + len(added)
+
+    for chunk in _chunked(removed, size):
+        for part in _chunked([current[x] for x in chunk]):
+            db.session.execute(usergroup.delete().where(and_(
+                usergroup.c.group_id == group_id,
+                usergroup.c.user_id.in_(part))))
+
+        touch(users=chunk, groups=[groupid])
+        done += len(chunk)
+        yield done, None
+
+    for chunk in _chunked(added, size):
+        for part in _chunked([found[x] for x in chunk]):
+            # skip anyone added since the job started
+            query = select([usergroup.c.user_id]).where(and_(
+                usergroup.c.group_id == group_id,
+                usergroup.c.user_id.in_(part)))
+            present = set(x.user_id for x in db.session.execute(query))
+
+            links = [{'user_id': x, 'group_id': group_id}
+                     for x in part if x not in present]
+            if links:
+                db.session.execute(usergroup.insert(), links)
+
+        touch(users=chunk, groups=[groupid])
+        done += len(chunk)
+        yield done, None
+
+
+def _delete_users(payload, result, size):
+    """ delete the users in payload['users'], skipping unknown ones """
+    users = _unique(payload['users'])
+    result.update(deleted=0, missing=0)
+
+    done = 0
+    yield done, len(users)
+
+    for chunk in _chunked(users, size):
+        deleted = len(delete_users(chunk))
+        result['deleted'] += deleted
+        result['missing'] += len(chunk) - deleted
+
+        done += len(chunk)
+        yield done, None
+
+
+def _upsert_users(payload, result, size):
+    """ create or update the user records in payload['users'] """
+    records = payload['users']
+    result.update(created=0, updated=0)
+
+    done = 0
+    yield done, len(records)
+
+    for chunk in _chunked(records, size):
+        for status in UserModel.upsert_many(chunk).values():
+            result[status] += 1
+
+        done += len(chunk)
+        yield done, None
+
+
+# job kind to a generator that makes the changes.  It yields
+# (done, total) once it has worked out the total, then (done, None)
+# after each chunk, each of which is committed on its own.
+JOB_KINDS = {
+    'replace_members': _replace_members,
+    'delete_users': _delete_users,
+    'upsert_users': _upsert_users,
+}
+
+
+def _set_state(job_id, **values):
+    jobs = JobModel.__table__
+    values['updated'] = datetime.datetime.utcnow()
+    return db.session.execute(jobs.update().where(
+        jobs.c.id == job_id).values(**values))
+
+
+def _requeue_stale():
+    """ put running jobs that have stopped making progress back in the
+    queue, to be run again from the start """
+    jobs = JobModel.__table__
+    now = datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(
+        seconds=current_app.config['JOBS_STALE_TIMEOUT'])
+
+    res = db.session.execute(jobs.update().where(and_(
+        jobs.c.status == 'running', jobs.c.updated < cutoff)).values(
+        status='queued', updated=now))
+    db.session.commit()
+    if res.rowcount:
+        LOG.warning('Requeued %d stale jobs', res.rowcount)
+
+
+def _claim():
+    """ mark the oldest queued job as running, returning its id """
+    jobs = JobModel.__table__
+    _requeue_stale()
+
+    query = select([jobs.c.id]).where(
+        jobs.c.status == 'queued').order_by(jobs.c.id)
+
+    for job_id, in db.session.execute(query.limit(10)).fetchall():
+        # another process may have got there first
+        res = db.session.execute(jobs.update().where(and_(
+            jobs.c.id == job_id, jobs.c.status == 'queued')).values(
+            status='running', updated=datetime.datetime.utcnow()))
+        db.session.commit()
+        if res.rowcount:
+            return job_id
+
+    return None
+
+
+def run_job(job_id):
+    """ run a claimed job to completion, recording its progress """
+    job = JobModel.query.get(job_id)
+    run = JOB_KINDS[job.kind]
+    payload = json.loads(job.payload)
+    size = current_app.config['JOBS_CHUNK_SIZE']
+    result = {}
+
+    try:
+        for done, total in run(payload, result, size):
+            if total is None:
+                _set_state(job_id, done=done)
+            else:
+                _set_state(job_id, done=done, total=total)
+            db.session.commit()
+    except Exception as e:
+        LOG.exception('Job %s failed', job_id)
+        db.session.rollback()
+        _set_state(job_id, status='failed', error=str(e),
+                   result=json.dumps(result))
+    else:
+        _set_state(job_id, status='done', result=json.dumps(result))
+
+    db.session.commit()
+
+
+def run_pending():
+    """ run queued jobs until there are none left
+
+    Returns:
+      number of jobs run
+    """
+    count = 0
+    job_id = _claim()
+    while job_id is not None:
+        run_job(job_id)
+        count += 1
+        job_id = _claim()
+
+    return count
+
+
+class JobWorker(object):
+    """ runs queued jobs on a background thread, started by the first
+    request or job.  Once running it also polls for jobs queued by
+    other processes, and for stale ones. """
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def notify(self):
+        """ start the worker if need be, and have it look for jobs """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run,
+                                                name='userapi-jobs')
+                self._thread.daemon = True
+                self._thread.start()
+
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        """ stop the worker once it finishes the job in hand """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+
+        self._wake.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        with self.app.app_context():
+            while not self._stopping:
+                self._wake.clear()
+                try:
+                    run_pending()
+                except Exception:
+                    LOG.exception('Job worker error')
+                finally:
+                    db.session.remove()
+
+                self._wake.wait(self.app.config['JOBS_POLL_INTERVAL'])
+
+
+def _start_worker():
+    get_worker().notify()
+
+
+def init_jobs(app):
+    app.extensions['userapi_jobs'] = JobWorker(app)
+
+    # each serving process runs its own worker, started once it is up
+    # (and forked, under gunicorn), so jobs left behind by a process
+    # that died are picked up without waiting for a new one
+    if app.config['JOBS_AUTOSTART']:
+        app.before_first_request(_start_worker)
+
+
+def get_worker():
+    return current_app.extensions['userapi_jobs']
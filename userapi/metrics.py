@@ -0,0 +1,206 @@
+# Opt-in per-request instrumentation: query counts, database time and
+# handler time per endpoint, reported in a Server-Timing header on every
+# response and in prometheus text format from /metrics.
+
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from userapi.admission import get_admission
+from userapi.cache import get_cache
+from userapi.database import get_engines
+from userapi.writes import get_batcher
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class Metrics(object):
+    """ Thread-safe per-endpoint totals, plus collectors for anything
+    else worth exporting """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._collectors = []
+
+    def record(self, endpoint, queries, db_time, handler_time):
+        with self._lock:
+            totals = self._endpoints.setdefault(endpoint, [0, 0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += queries
+            totals[2] += db_time
+            totals[3] += handler_time
+
+    def add_collector(self, collector):
+        """ add a function returning a list of (name, type, help,
+        samples) tuples, where samples is a list of (labels, value) """
+        self._collectors.append(collector)
+
+    def collect(self):
+        with self._lock:
+            endpoints = sorted(
+                (x, list(y)) for x, y in self._endpoints.items())
+
+        def samples(index):
+            return [({'endpoint': x}, y[index]) for x, y in endpoints]
+
+        metrics = [
+            ('userapi_request_duration_seconds_count', 'counter',
+             'Requests handled', samples(0)),
+            ('userapi_request_duration_seconds_sum', 'counter',
+             'Time spent in request handlers', samples(3)),
+            ('userapi_db_queries_total', 'counter',
+             'SQL statements executed', samples(1)),
+            ('userapi_db_duration_seconds_total', 'counter',
+             'Time spent executing SQL statements', samples(2)),
+        ]
+
+        for collector in self._collectors:
+            metrics.extend(collector())
+
+        return metrics
+
+    def render(self):
+        """ format everything in the prometheus text exposition format """
+        lines = []
+        for name, kind, text, samples in self.collect():
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                label_text = ','.join(
+                    '%s="%s"' % (k, _escape(v))
+                    for k, v in sorted(labels.items()))
+                lines.append('%s%s %s' % (
+                    name, '{%s}' % label_text if label_text else '',
+                    repr(float(value))))
+
+        return '\n'.join(lines) + '\n'
+
+
+def get_metrics():
+    return current_app.extensions.get('userapi_metrics')
+
+
+def _cache_stats():
+    cache = get_cache()
+    if cache is None:
+        return []
+
+    stats = cache.stats()
+    return [
+        ('userapi_cache_hits_total', 'counter', 'Cache hits',
+         [({}, stats['hits'])]),
+        ('userapi_cache_misses_total', 'counter', 'Cache misses',
+         [({}, stats['misses'])]),
+        ('userapi_cache_entries', 'gauge', 'Cached entries',
+         [({}, stats['entries'])]),
+    ]
+
+
+def _write_stats():
+    batcher = get_batcher()
+    if batcher is None:
+        return []
+
+    stats = batcher.stats()
+    return [
+        ('userapi_write_batches_total', 'counter', 'Write batches committed',
+         [({}, stats['batches'])]),
+        ('userapi_write_batched_total', 'counter', 'Writes applied in batches',
+         [({}, stats['writes'])]),
+        ('userapi_write_batch_size_max', 'gauge', 'Largest write batch',
+         [({}, stats['largest'])]),
+        ('userapi_write_wait_seconds_total', 'counter',
+         'Time writes spent queued and applied',
+         [({}, stats['wait'])]),
+    ]
+
+
+def _admission_stats():
+    admission = get_admission()
+    if admission is None:
+        return []
+
+    stats = admission.stats()
+    concurrency = sorted(stats['concurrency'].items())
+    rates = sorted(stats['rate'].items())
+
+    def samples(key):
+        return [({'endpoint': x}, y[key]) for x, y in concurrency]
+
+    rejected = [({'endpoint': x, 'reason': 'concurrency'}, y['rejected'])
+                for x, y in concurrency]
+    rejected += [({'endpoint': x, 'reason': 'rate'}, y['rejected'])
+                 for x, y in rates]
+
+    return [
+        ('userapi_admission_active', 'gauge',
+         'Requests running under a concurrency limit', samples('active')),
+        ('userapi_admission_waiting', 'gauge',
+         'Requests waiting under a concurrency limit', samples('waiting')),
+        ('userapi_admission_queued_total', 'counter',
+         'Requests that had to wait for a turn', samples('queued')),
+        ('userapi_admission_rejected_total', 'counter',
+         'Requests turned away by admission control', rejected),
+    ]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.time() - conn.info['query_start'].pop()
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+        g.db_time += elapsed
+
+
+def _before_request():
+    g.request_start = time.time()
+    g.db_queries = 0
+    g.db_time = 0.0
+
+
+def _after_request(response):
+    if 'request_start' not in g:
+        return response
+
+    handler_time = time.time() - g.request_start
+    get_metrics().record(request.endpoint or 'unknown', g.db_queries,
+                         g.db_time, handler_time)
+
+    response.headers['Server-Timing'] = (
+        'db;dur=%.3f;desc="%d queries", app;dur=%.3f' % (
+            g.db_time * 1000, g.db_queries, handler_time * 1000))
+
+    return response
+
+
+def init_metrics(app):
+    """ hook up instrumentation for an app, if METRICS is set """
+    if not app.config['METRICS']:
+        return
+
+    metrics = Metrics()
+    metrics.add_collector(_cache_stats)
+    metrics.add_collector(_write_stats)
+    metrics.add_collector(_admission_stats)
+    app.extensions['userapi_metrics'] = metrics
+
+    # snapshot mode has no database
+    if 'sqlalchemy' in app.extensions:
+        for engine in get_engines(app):
+            event.listen(engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
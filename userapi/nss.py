@@ -0,0 +1,174 @@
+# passwd and group format flat files, for hosts that look users up
+# locally (e.g. with nss-altfiles or libnss-extrausers) rather than over
+# http.
+#
+# The files are kept up to date incrementally.  A state file next to
+# them records the directory serial and change log position they were
+# written at; the next run reads only the rows whose version is newer,
+# and the deletes logged since, and merges them into the existing
+# files.  Files are only rewritten when something in them changed, and
+# are replaced atomically by renaming a finished temporary file over
+# them.
+
+import io
+import json
+import logging
+import os
+
+from flask import current_app
+from sqlalchemy import and_, select
+
+from userapi.database import db
+from userapi.database.model import (GroupModel, UserModel, _chunked,
+                                    changes, current_serial,
+                                    get_groups_members, last_change)
+
+LOG = logging.getLogger(__name__)
+
+STATE_FILE = '.userapi-nss'
+
+# characters that would break the colon and comma separated formats,
+# besides control characters
+_SEPARATORS = frozenset(':,')
+
+
+def _unsafe(char):
+    return char in _SEPARATORS or ord(char) < 32 or ord(char) == 127
+
+
+def _safe(name):
+    return not any(_unsafe(x) for x in name)
+
+
+def _gecos(row):
+    gecos = ' '.join(x for x in [row.first_name, row.last_name] if x)
+    return ''.join(' ' if _unsafe(x) else x for x in gecos)
+
+
+def _name(line):
+    return line.split(':', 1)[0]
+
+
+def _passwd_line(row, config):
+    return '%s:x:%d:%d:%s:%s:%s' % (
+        row.userid, config['NSS_UID_BASE'] + row.id,
+        config['NSS_PRIMARY_GID'], _gecos(row),
+        config['NSS_HOME'] % row.userid, config['NSS_SHELL'])
+
+
+def _group_line(row, members, config):
+    return '%s:x:%d:%s' % (row.groupid, config['NSS_GID_BASE'] + row.id,
+                           ','.join(x for x in members if _safe(x)))
+
+
+def _read_entries(path):
+    """ the lines of an existing file, by name """
+    entries = {}
+    if os.path.exists(path):
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line:
+                    entries[_name(line)] = line
+    return entries
+
+
+def _write_atomic(path, data):
+    tmp = '%s.tmp.%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data.encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+
+
+def _write_entries(path, entries):
+    _write_atomic(path, ''.join('%s\n' % entries[x]
+                                for x in sorted(entries)))
+
+
+def _deleted(kind, since, upto):
+    query = select([changes.c.name]).where(and_(
+        changes.c.seq > since, changes.c.seq <= upto,
+        changes.c.kind == kind, changes.c.op == 'delete'))
+    return set(x.name for x in db.session.execute(query))
+
+
+def _changed_rows(columns, version, since):
+    query = select(columns)
+    if since is not None:
+        query = query.where(version > since)
+    return db.session.execute(query).fetchall()
+
+
+def export_nss(directory):
+    """ bring the passwd and group files in directory up to date
+
+    Returns:
+      dict of the number of 'users' and 'groups' written, and whether it
+      was a 'full' export
+    """
+    config = current_app.config
+    users = UserModel.__table__
+    groups = GroupModel.__table__
+
+    passwd_path = os.path.join(directory, 'passwd')
+    group_path = os.path.join(directory, 'group')
+    state_path = os.path.join(directory, STATE_FILE)
+
+    state = None
+    if (os.path.exists(state_path) and os.path.exists(passwd_path) and
+            os.path.exists(group_path)):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    # anything committed after these are read gets picked up again next
+    # time, which is harmless as every step is idempotent
+    serial = current_serial()
+    seq = last_change()
+    since = state['serial'] if state else None
+
+    if state and state['serial'] == serial and state['seq'] == seq:
+        return {'users': 0, 'groups': 0, 'full': False}
+
+    passwd = _read_entries(passwd_path) if state else {}
+    group = _read_entries(group_path) if state else {}
+    passwd_dirty = group_dirty = state is None
+
+    if state:
+        for name in _deleted('user', state['seq'], seq):
+            passwd_dirty |= passwd.pop(name, None) is not None
+        for name in _deleted('group', state['seq'], seq):
+            group_dirty |= group.pop(name, None) is not None
+
+    user_rows = _changed_rows([users.c.id, users.c.userid,
+                               users.c.first_name, users.c.last_name],
+                              users.c.version, since)
+    for row in user_rows:
+        if _safe(row.userid):
+            passwd[row.userid] = _passwd_line(row, config)
+            passwd_dirty = True
+        else:
+            LOG.warning('Skipping user %r', row.userid)
+
+    group_rows = [x for x in _changed_rows(
+        [groups.c.id, groups.c.groupid], groups.c.version, since)
+        if _safe(x.groupid)]
+    for chunk in _chunked(group_rows):
+        members = get_groups_members(x.groupid for x in chunk)
+        for row in chunk:
+            group[row.groupid] = _group_line(
+                row, members.get(row.groupid, []), config)
+            group_dirty = True
+    db.session.commit()
+
+    if passwd_dirty:
+        _write_entries(passwd_path, passwd)
+    if group_dirty:
+        _write_entries(group_path, group)
+
+    _write_atomic(state_path, json.dumps({'serial': serial, 'seq': seq}))
+
+    return {'users': len(user_rows), 'groups': len(group_rows),
+            'full': state is None}
@@ -0,0 +1,52 @@
+# Production serving.  Uses gunicorn's pre-fork server when it is
+# installed, and falls back to werkzeug's threaded server otherwise.
+
+import logging
+
+from werkzeug.serving import run_simple
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+LOG = logging.getLogger(__name__)
+
+
+if BaseApplication is not None:
+    class _GunicornApplication(BaseApplication):
+        """ run an already created wsgi app under gunicorn """
+
+        def __init__(self, app, options):
+            self.application = app
+            self.options = options
+            super(_GunicornApplication, self).__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+
+def serve(app, host, port, workers, threads):
+    """ serve app with workers processes of threads threads each """
+    app.debug = False
+
+    if BaseApplication is None:
+        if workers > 1:
+            LOG.warning('gunicorn is not installed, serving from a single '
+                        'process')
+
+        run_simple(host, port, app, threaded=threads > 1,
+                   use_reloader=False, use_debugger=False)
+        return
+
+    _GunicornApplication(app, {
+        'bind': '%s:%d' % (host, port),
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'timeout': app.config['SERVER_TIMEOUT'],
+    }).run()
@@ -0,0 +1,436 @@
+# Compiled, read-only snapshots of the directory.
+#
+# A snapshot is a single file holding everything the GET endpoints need,
+# laid out to be memory-mapped and searched in place:
+#
+#   - sorted string tables of userids and groupids: an array of uint32
+#     offsets into a blob of utf-8 strings, sorted bytewise so lookups
+#     are a binary search.  Users and groups are then numbered by their
+#     position in these tables.
+#   - first and last names, and versions, in user order, and versions in
+#     group order.
+#   - adjacency arrays (an offset array into a flat array of positions)
+#     for each user's groups, each group's members, each group's direct
+#     subgroups and each group's ancestors through nesting.
+#
+# All numbers are little-endian.  Snapshots are written to a temporary
+# file and renamed into place, so readers see either the old file or the
+# new one, and SnapshotStore picks up the new one when it appears.
+
+import mmap
+import os
+import struct
+import threading
+
+from flask import current_app
+from sqlalchemy import select
+
+from userapi.database import db
+from userapi.database.model import (GroupModel, UserModel, current_serial,
+                                    groupclosure, groupgroup, usergroup)
+
+MAGIC = b'UAPISNP1'
+
+_HEADER = struct.Struct('<8sQII')
+_SECTION = struct.Struct('<QQ')
+
+SECTIONS = ['user_offsets', 'user_blob', 'field_offsets', 'field_blob',
+            'user_versions', 'group_offsets', 'group_blob',
+            'group_versions', 'user_groups_index', 'user_groups',
+            'group_users_index', 'group_users', 'group_children_index',
+            'group_children', 'group_ancestors_index', 'group_ancestors']
+
+
+def _u32s(values):
+    return struct.pack('<%dI' % len(values), *values)
+
+
+def _u64s(values):
+    return struct.pack('<%dQ' % len(values), *values)
+
+
+def _string_table(strings):
+    offsets = [0]
+    for x in strings:
+        offsets.append(offsets[-1] + len(x))
+    return _u32s(offsets), b''.join(strings)
+
+
+def _adjacency(lists):
+    offsets = [0]
+    for x in lists:
+        offsets.append(offsets[-1] + len(x))
+    return _u32s(offsets), _u32s([y for x in lists for y in x])
+
+
+def _key(name):
+    return name.encode('utf-8')
+
+
+def _read_directory():
+    users_t = UserModel.__table__
+    groups_t = GroupModel.__table__
+
+    users = sorted(db.session.execute(select([
+        users_t.c.id, users_t.c.userid, users_t.c.first_name,
+        users_t.c.last_name, users_t.c.version])).fetchall(),
+        key=lambda x: _key(x.userid))
+    groups = sorted(db.session.execute(select([
+        groups_t.c.id, groups_t.c.groupid, groups_t.c.version])).fetchall(),
+        key=lambda x: _key(x.groupid))
+
+    user_pos = dict((x.id, i) for i, x in enumerate(users))
+    group_pos = dict((x.id, i) for i, x in enumerate(groups))
+
+    user_groups = [[] for _ in users]
+    group_users = [[] for _ in groups]
+    for user_id, group_id in db.session.execute(select([
+            usergroup.c.user_id, usergroup.c.group_id])):
+        user_groups[user_pos[user_id]].append(group_pos[group_id])
+        group_users[group_pos[group_id]].append(user_pos[user_id])
+
+    group_children = [[] for _ in groups]
+    for parent_id, child_id in db.session.execute(select([
+            groupgroup.c.parent_id, groupgroup.c.child_id])):
+        group_children[group_pos[parent_id]].append(group_pos[child_id])
+
+    group_ancestors = [[] for _ in groups]
+    for ancestor_id, descendant_id in db.session.execute(select([
+            groupclosure.c.ancestor_id, groupclosure.c.descendant_id])):
+        group_ancestors[group_pos[descendant_id]].append(
+            group_pos[ancestor_id])
+
+    # positions follow name order, so sorted lists come out in name order
+    for lists in [user_groups, group_users, group_children,
+                  group_ancestors]:
+        for x in lists:
+            x.sort()
+
+    return (users, groups, user_groups, group_users, group_children,
+            group_ancestors)
+
+
+def compile_snapshot(path, attempts=5):
+    """ write a snapshot of the database to path, replacing any existing
+    file atomically
+
+    The tables are read with separate queries, so the read is retried
+    if the directory serial moves while it runs.
+
+    Returns:
+      tuple of the number of users and groups written
+    """
+    for _ in range(attempts):
+        serial = current_serial()
+        try:
+            directory = _read_directory()
+        except KeyError:
+            # a link to a row added after its table was read
+            directory = None
+
+        changed = current_serial() != serial
+        db.session.commit()
+        if directory is not None and not changed:
+            break
+    else:
+        raise RuntimeError('Directory kept changing, try again later')
+
+    (users, groups, user_groups, group_users, group_children,
+     group_ancestors) = directory
+
+    fields = []
+    for x in users:
+        fields.extend([_key(x.first_name or ''), _key(x.last_name or '')])
+
+    sections = []
+    sections.extend(_string_table([_key(x.userid) for x in users]))
+    sections.extend(_string_table(fields))
+    sections.append(_u64s([x.version for x in users]))
+    sections.extend(_string_table([_key(x.groupid) for x in groups]))
+    sections.append(_u64s([x.version for x in groups]))
+    for lists in [user_groups, group_users, group_children,
+                  group_ancestors]:
+        sections.extend(_adjacency(lists))
+
+    # sections start on 8 byte boundaries, after the header
+    offset = _HEADER.size + _SECTION.size * len(SECTIONS)
+    table = []
+    for data in sections:
+        offset += -offset % 8
+        table.append(_SECTION.pack(offset, len(data)))
+        offset += len(data)
+
+    tmp = '%s.tmp.%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, serial, len(users), len(groups)))
+        f.write(b''.join(table))
+        for data in sections:
+            f.write(b'\0' * (-f.tell() % 8))
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+    return len(users), len(groups)
+
+
+class _StringTable(object):
+    """ sorted strings, searched in place """
+
+    def __init__(self, buf, offsets, blob, count):
+        self._buf = buf
+        self._offsets = offsets
+        self._blob = blob
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def raw(self, i):
+        start, end = struct.unpack_from('<2I', self._buf,
+                                        self._offsets + 4 * i)
+        return self._buf[self._blob + start:self._blob + end]
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8')
+
+    def bisect(self, key):
+        """ position of the first string not less than key, in bytes """
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, name):
+        """ position of name, or None """
+        key = _key(name)
+        i = self.bisect(key)
+        if i < self._count and self.raw(i) == key:
+            return i
+        return None
+
+
+class _Adjacency(object):
+    """ a list of positions for each position """
+
+    def __init__(self, buf, index, values):
+        self._buf = buf
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, i):
+        start, end = struct.unpack_from('<2I', self._buf,
+                                        self._index + 4 * i)
+        return struct.unpack_from('<%dI' % (end - start), self._buf,
+                                  self._values + 4 * start)
+
+
+class Snapshot(object):
+    """ a memory-mapped snapshot file.  Lookups mirror the functions in
+    userapi.database.model, and return the same shapes. """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.serial, n_users, n_groups = _HEADER.unpack_from(
+            self._buf, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a snapshot' % path)
+
+        sections = {}
+        for i, name in enumerate(SECTIONS):
+            sections[name] = _SECTION.unpack_from(
+                self._buf, _HEADER.size + _SECTION.size * i)[0]
+
+        def table(name, count):
+            return _StringTable(self._buf, sections[name + '_offsets'],
+                                sections[name + '_blob'], count)
+
+        def adjacency(name):
+            return _Adjacency(self._buf, sections[name + '_index'],
+                              sections[name])
+
+        self._users = table('user', n_users)
+        self._fields = table('field', 2 * n_users)
+        self._user_versions = sections['user_versions']
+        self._groups = table('group', n_groups)
+        self._group_versions = sections['group_versions']
+        self._user_groups = adjacency('user_groups')
+        self._group_users = adjacency('group_users')
+        self._group_children = adjacency('group_children')
+        self._group_ancestors = adjacency('group_ancestors')
+
+    def _version(self, section, i):
+        return struct.unpack_from('<Q', self._buf, section + 8 * i)[0]
+
+    def _record(self, i):
+        return {'userid': self._users[i],
+                'first_name': self._fields[2 * i],
+                'last_name': self._fields[2 * i + 1],
+                'groups': [self._groups[x] for x in self._user_groups[i]]}
+
+    def get_user_version(self, userid):
+        i = self._users.find(userid)
+        return None if i is None else self._version(self._user_versions, i)
+
+    def get_group_version(self, groupid):
+        i = self._groups.find(groupid)
+        return None if i is None else self._version(self._group_versions, i)
+
+    def get_user(self, userid):
+        i = self._users.find(userid)
+        if i is None:
+            return None
+        return self._version(self._user_versions, i), self._record(i)
+
+    def get_users(self, userids):
+        res = {}
+        for userid in userids:
+            i = self._users.find(userid)
+            if i is not None:
+                res[userid] = self._record(i)
+        return res
+
+    def _members(self, i):
+        return [self._users[x] for x in self._group_users[i]]
+
+    def get_group_members(self, groupid):
+        i = self._groups.find(groupid)
+        if i is None:
+            return None
+        return self._version(self._group_versions, i), self._members(i)
+
+    def get_groups_members(self, groupids):
+        res = {}
+        for groupid in groupids:
+            i = self._groups.find(groupid)
+            if i is not None:
+                res[groupid] = self._members(i)
+        return res
+
+    def get_subgroups(self, groupid):
+        i = self._groups.find(groupid)
+        if i is None:
+            return None
+        return [self._groups[x] for x in self._group_children[i]]
+
+    def is_member(self, userid, groupid):
+        i = self._users.find(userid)
+        j = self._groups.find(groupid)
+        return i is not None and j is not None and j in self._user_groups[i]
+
+    def _effective(self, i):
+        found = set(self._user_groups[i])
+        for x in self._user_groups[i]:
+            found.update(self._group_ancestors[x])
+        return found
+
+    def get_effective_groups(self, userid):
+        i = self._users.find(userid)
+        if i is None:
+            return None
+        return [self._groups[x] for x in sorted(self._effective(i))]
+
+    def is_effective_member(self, userid, groupid):
+        i = self._users.find(userid)
+        j = self._groups.find(groupid)
+        return i is not None and j is not None and j in self._effective(i)
+
+    def list_groups(self, after=None, count=None):
+        """ groupids in order, after the given one, up to count """
+        start = 0 if after is None else self._groups.bisect(
+            _key(after) + b'\0')
+        end = len(self._groups)
+        if count is not None:
+            end = min(end, start + count)
+        return [self._groups[x] for x in range(start, end)]
+
+    def list_users(self, after=None, count=None, prefix=None, name=None,
+                   groups=None, match_all=False):
+        """ userids in order, after the given one, up to count, filtered
+        as for userapi.database.model.user_filters """
+        start = 0 if after is None else self._users.bisect(
+            _key(after) + b'\0')
+        if prefix:
+            start = max(start, self._users.bisect(_key(prefix)))
+
+        if groups:
+            positions = [self._groups.find(x) for x in set(groups)]
+            known = [self._group_users[x] for x in positions
+                     if x is not None]
+            if not match_all:
+                members = set().union(*known)
+            elif len(known) < len(positions):
+                members = set()
+            else:
+                members = set(known[0]).intersection(*known[1:])
+            candidates = (x for x in sorted(members) if x >= start)
+        else:
+            candidates = iter(range(start, len(self._users)))
+
+        prefix = _key(prefix) if prefix else None
+        name = name.lower() if name else None
+
+        res = []
+        for i in candidates:
+            if count is not None and len(res) >= count:
+                break
+            # everything from start sorts at or after prefix, so the
+            # first miss is the end of the range
+            if prefix and not self._users.raw(i).startswith(prefix):
+                break
+            if name and not (self._fields[2 * i].lower().startswith(name) or
+                             self._fields[2 * i + 1].lower().startswith(
+                                 name)):
+                continue
+            res.append(self._users[i])
+        return res
+
+    def iter_users(self):
+        for i in range(len(self._users)):
+            yield self._record(i)
+
+
+class SnapshotStore(object):
+    """ the current snapshot for a path.  A new file renamed over it is
+    opened on the next lookup; requests already holding the old snapshot
+    carry on with it. """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stat = None
+        self._snapshot = None
+        self.get()
+
+    def get(self):
+        try:
+            st = os.stat(self.path)
+            stat = (st.st_ino, st.st_mtime, st.st_size)
+        except OSError:
+            # keep serving what we have if the file goes missing
+            if self._snapshot is None:
+                raise
+            return self._snapshot
+
+        if stat != self._stat:
+            with self._lock:
+                if stat != self._stat:
+                    self._snapshot = Snapshot(self.path)
+                    self._stat = stat
+
+        return self._snapshot
+
+
+def init_snapshot(app):
+    app.extensions['userapi_snapshot'] = SnapshotStore(
+        app.config['SNAPSHOT_PATH'])
+
+
+def get_snapshot():
+    return current_app.extensions['userapi_snapshot'].get()
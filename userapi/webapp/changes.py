@@ -0,0 +1,63 @@
+import time
+
+from flask import Blueprint, current_app, request, make_response
+from flask.ext import restful
+
+from userapi.database import db
+from userapi.database.model import get_changes, last_change
+from userapi.webapp.representation import output_json
+
+changes_bp = Blueprint('changes', __name__)
+changes_api = restful.Api(changes_bp)
+changes_api.representation('application/json')(output_json)
+
+
+class Changes(restful.Resource):
+    """ Change feed for incremental sync """
+
+    @changes_api.representation('text/plain')
+    def _plain(self, data, code, headers=None):
+        resp = make_response(data, code)
+        resp.headers.extend(headers or {})
+        return resp
+
+    def get(self):
+        """ list changes after a sequence number
+
+        Takes query args 'since' (default 0), the last sequence number
+        the client has seen, 'limit' on the number of changes, and
+        'wait', a number of seconds to long-poll for when there are no
+        new changes.  Feed 'next' back in as 'since' on the next call.
+
+        Returns:
+          200 - json object with a list of 'changes' and 'next'
+          400 - invalid arguments
+        """
+        config = current_app.config
+
+        try:
+            since = int(request.args.get('since', 0))
+            limit = int(request.args.get('limit', config['MAX_PAGE_SIZE']))
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            return self._plain('Invalid arguments', 400)
+
+        if limit < 1:
+            return self._plain('Invalid arguments', 400)
+
+        limit = min(limit, config['MAX_PAGE_SIZE'])
+        deadline = time.time() + min(wait, config['CHANGES_MAX_WAIT'])
+
+        # poll the cheap max(seq) lookup until something turns up, and
+        # hand the connection back while sleeping
+        while last_change() <= since and time.time() < deadline:
+            db.session.close()
+            time.sleep(config['CHANGES_POLL_INTERVAL'])
+
+        entries = get_changes(since, limit)
+
+        return {'changes': entries,
+                'next': entries[-1]['seq'] if entries else since}
+
+
+changes_api.add_resource(Changes, '/')
@@ -0,0 +1,26 @@
+from flask import Blueprint, Response, stream_with_context
+from flask.ext import restful
+
+from userapi.database.model import iter_users
+from userapi.webapp.representation import dumps
+
+export_bp = Blueprint('export', __name__)
+export_api = restful.Api(export_bp)
+
+
+class Export(restful.Resource):
+    """ Full directory export """
+
+    def get(self):
+        """ stream every user, with names and groups, as newline
+        delimited json
+
+        Returns:
+          200 - success, with one json user object per line
+        """
+        lines = (dumps(x) + '\n' for x in iter_users())
+        return Response(stream_with_context(lines),
+                        mimetype='application/x-ndjson')
+
+
+export_api.add_resource(Export, '/')
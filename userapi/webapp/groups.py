@@ -1,13 +1,24 @@
 import json
 
-from flask import Blueprint, request, make_response
+from flask import Blueprint, current_app, request, make_response
 from flask.ext import restful
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
+from userapi.cache import cached, get_cache
 from userapi.database import db
-from userapi.database.model import GroupModel
+from userapi.database.model import (GroupModel, UserModel, current_serial,
+                                    delete_groups, get_group_members,
+                                    get_group_version, get_groups_members,
+                                    is_member, touch)
+from userapi.webapp.jobs import _check_names
+from userapi.webapp.paging import paginate, requested_ids
+from userapi.webapp.representation import output_json
+from userapi.webapp.versioning import etag, not_modified, versioned_get
+from userapi.writes import Rollback, apply_write
 
 groups_bp = Blueprint('groups', __name__)
 groups_api = restful.Api(groups_bp)
+groups_api.representation('application/json')(output_json)
 
 
 class Groups(restful.Resource):
@@ -25,33 +36,43 @@ class Groups(restful.Resource):
 
         Returns:
           200 - if group exists, plus json list of users
+          304 - not modified since the ETag in If-None-Match
           404 - if group does not exist
         """
-        group = GroupModel.query.filter_by(groupid=groupid).first()
-        if not group:
+        res = versioned_get(('group', groupid),
+                            lambda: get_group_version(groupid),
+                            lambda: get_group_members(groupid))
+        if res is None:
             return self._plain('Group not found', 404)
 
-        if len(group.users) == 0:
+        version, members = res
+        headers = {'ETag': etag(version)}
+        if members is None:
+            return self._plain('', 304, headers)
+
+        if len(members) == 0:
             return self._plain('Group empty', 404)
 
-        return group.users
+        return members, 200, headers
 
     def delete(self, groupid):
         """ delete the specified group object
 
         Returns:
+          500 - internal sql alchemy error
           200 - deleted
           404 - group not found
         """
-        group = GroupModel.query.filter_by(groupid=groupid).first()
-        if not group:
-            return self._plain('Group not found', 404)
+        def write():
+            if not delete_groups([groupid]):
+                raise Rollback(('Group not found', 404))
 
-        # we have some cascading deletes to do as well
-        db.session.delete(group)
-        db.session.commit()
+            return 'Deleted successfully', 200
 
-        return self._plain('Deleted successfully', 200)
+        try:
+            return self._plain(*apply_write(write))
+        except SQLAlchemyError:
+            return self._plain('Error deleting group', 500)
 
     def post(self, groupid):
         """ create group
@@ -60,52 +81,263 @@ class Groups(restful.Resource):
           201 - group created
           409 - group exists
         """
-        if GroupModel.query.filter_by(groupid=groupid).first():
-            return self._plain('Group exists', 409)
+        def write():
+            if GroupModel.query.filter_by(groupid=groupid).first():
+                raise Rollback(('Group exists', 409))
 
-        new_group = GroupModel(groupid)
+            db.session.add(GroupModel(groupid))
+            touch(groups=[groupid])
+            return 'Added Successfully', 201
 
-        db.session.add(new_group)
-        db.session.commit()
-
-        return self._plain('Added Successfully', 201)
+        return self._plain(*apply_write(write))
 
     def put(self, groupid):
         """ update the membership list of a group
 
+        Takes either a json list of member userids, or a json object with
+        a 'users' list and/or a 'groups' list of groupids to nest in
+        this group.
+
         Returns:
           200 - updated
           404 - group not found
-          400 - invalid JSON or bad user specified
+          400 - invalid JSON, bad user or group specified, or the
+                nesting would make a cycle
         """
-        group = GroupModel.query.filter_by(groupid=groupid).first()
-        if not group:
-            return self._plain('Group not found', 404)
-
         try:
             data = json.loads(request.data)
         except ValueError:
             return self._plain("Invalid json", 400)
 
-        db.session.add(group)
+        if not isinstance(data, dict):
+            data = {'users': data}
 
         try:
-            group.users = data
+            for field in ['users', 'groups']:
+                if field in data:
+                    _check_names(data[field], field)
         except ValueError as e:
-            db.session.rollback()
-            return self._plain(
-                'Error updating group membership: %s' % str(e), 400)
+            return self._plain(str(e), 400)
+
+        def write():
+            group = GroupModel.query.filter_by(groupid=groupid).first()
+            if not group:
+                raise Rollback(('Group not found', 404))
+
+            touched = set()
+            try:
+                if 'users' in data:
+                    touched.update(
+                        set(group.users).symmetric_difference(data['users']))
+                    group.users = data['users']
+                if 'groups' in data:
+                    # no user record holds effective groups, so nesting
+                    # is a change to this group alone
+                    group.subgroups = data['groups']
+            except ValueError as e:
+                raise Rollback((
+                    'Error updating group membership: %s' % str(e), 400))
+
+            touch(users=touched, groups=[groupid])
+            return 'Updated Successfully', 200
+
+        return self._plain(*apply_write(write))
+
+
+def _member_set(groupid):
+    res = get_group_members(groupid)
+    if res is None:
+        return None
+
+    return frozenset(res[1])
+
+
+class GroupMembers(restful.Resource):
+    """ Add or remove single group members """
+
+    @groups_api.representation('text/plain')
+    def _plain(self, data, code, headers=None):
+        resp = make_response(data, code)
+        resp.headers.extend(headers or {})
+        return resp
+
+    def _lookup(self, groupid, userid):
+        """ find the group and the user row id, raising Rollback with an
+        error response if either is missing """
+        group = GroupModel.query.filter_by(groupid=groupid).first()
+        if not group:
+            raise Rollback(('Group not found', 404))
+
+        user_id = db.session.query(UserModel.id).filter_by(
+            userid=userid).scalar()
+        if user_id is None:
+            raise Rollback(('User not found', 404))
+
+        return group, user_id
+
+    def get(self, groupid, userid):
+        """ check whether a user is a direct member of the group.  HEAD
+        works the same way.
+
+        With MEMBERSHIP_INDEX set, the check is answered from a cached
+        set of the group's members, otherwise from a single-row query.
+
+        Returns:
+          204 - user is in the group
+          404 - user is not in the group, or either does not exist
+        """
+        if current_app.config['MEMBERSHIP_INDEX'] and get_cache():
+            members = cached(('members', groupid), lambda: _member_set(
+                groupid))
+            found = members is not None and userid in members
+        else:
+            found = is_member(userid, groupid)
+
+        if not found:
+            return self._plain('Not a member', 404)
+
+        return self._plain('', 204)
+
+    def post(self, groupid, userid):
+        """ add a user to the group
+
+        Returns:
+          201 - added
+          404 - group or user not found
+          409 - user already in group
+        """
+        def write():
+            group, user_id = self._lookup(groupid, userid)
+            if not group.add_member(user_id):
+                raise Rollback(('User already in group', 409))
+
+            touch(users=[userid], groups=[groupid])
+            return 'Added Successfully', 201
+
+        try:
+            return self._plain(*apply_write(write))
+        except IntegrityError:
+            # lost a race with another add of the same member
+            return self._plain('User already in group', 409)
+
+    def delete(self, groupid, userid):
+        """ remove a user from the group
+
+        Returns:
+          200 - removed
+          404 - group or user not found, or user not in group
+        """
+        def write():
+            group, user_id = self._lookup(groupid, userid)
+            if not group.remove_member(user_id):
+                raise Rollback(('User not in group', 404))
+
+            touch(users=[userid], groups=[groupid])
+            return 'Deleted successfully', 200
 
-        db.session.commit()
+        return self._plain(*apply_write(write))
 
-        return self._plain('Updated Successfully', 200)
+
+class Subgroups(restful.Resource):
+    """ Groups nested in a group """
+
+    @groups_api.representation('text/plain')
+    def _plain(self, data, code, headers=None):
+        resp = make_response(data, code)
+        resp.headers.extend(headers or {})
+        return resp
+
+    def get(self, groupid):
+        """ list the groups nested directly in the specified group
+
+        Returns:
+          200 - json list of groupids
+          404 - group not found
+        """
+        group = GroupModel.query.filter_by(groupid=groupid).first()
+        if not group:
+            return self._plain('Group not found', 404)
+
+        return group.subgroups
 
 
 class GroupsList(restful.Resource):
     """ see the whole group list """
+
+    @groups_api.representation('text/plain')
+    def _plain(self, data, code, headers=None):
+        resp = make_response(data, code)
+        resp.headers.extend(headers or {})
+        return resp
+
     def get(self):
-        return [x.groupid for x in GroupModel.query.all()]
+        """ list groupids
+
+        With an 'ids' query arg of comma separated groupids, returns a
+        json object of each of those groupids to its member list, or to
+        null for groups that don't exist.
+
+        Otherwise takes optional 'limit' and 'after' query args to page
+        through the list in groupid order.
+
+        Returns:
+          200 - json list of groupids, with a Link header to the next page
+          304 - directory not modified since the ETag in If-None-Match
+          400 - invalid limit, or too many ids
+        """
+        serial = current_serial()
+        if not_modified(serial):
+            return self._plain('', 304, {'ETag': etag(serial)})
+
+        try:
+            ids = requested_ids()
+        except ValueError as e:
+            return self._plain(str(e), 400)
+
+        if ids is not None:
+            groups = get_groups_members(ids)
+            return (dict((x, groups.get(x)) for x in ids), 200,
+                    {'ETag': etag(serial)})
+
+        try:
+            names, headers = paginate(GroupModel.groupid)
+        except ValueError:
+            return self._plain('Invalid limit', 400)
+
+        headers['ETag'] = etag(serial)
+        return names, 200, headers
+
+    def delete(self):
+        """ delete many groups in a single transaction
+
+        Takes an 'ids' query arg of comma separated groupids.
+
+        Returns:
+          200 - json object with the 'deleted' groupids, and the
+                'missing' ones that did not exist
+          400 - no ids, or too many
+          500 - internal sql alchemy error
+        """
+        try:
+            ids = requested_ids()
+        except ValueError as e:
+            return self._plain(str(e), 400)
+
+        if not ids:
+            return self._plain('Missing ids', 400)
+
+        try:
+            deleted = apply_write(lambda: delete_groups(ids))
+        except SQLAlchemyError:
+            return self._plain('Error deleting groups', 500)
+
+        found = set(deleted)
+        return {'deleted': deleted,
+                'missing': [x for x in ids if x not in found]}
 
 
 groups_api.add_resource(Groups, '/<string:groupid>')
+groups_api.add_resource(GroupMembers,
+                        '/<string:groupid>/members/<string:userid>')
+groups_api.add_resource(Subgroups, '/<string:groupid>/subgroups')
 groups_api.add_resource(GroupsList, '/')
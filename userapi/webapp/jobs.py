@@ -0,0 +1,125 @@
+import json
+
+from flask import Blueprint, request, make_response, url_for
+from flask.ext import restful
+from six import string_types
+
+from userapi.database import db
+from userapi.database.model import JobModel, get_job
+from userapi.jobs import JOB_KINDS, get_worker
+from userapi.webapp.representation import output_json
+from userapi.webapp.users import _check_record
+
+jobs_bp = Blueprint('jobs', __name__)
+jobs_api = restful.Api(jobs_bp)
+jobs_api.representation('application/json')(output_json)
+
+
+def _check_names(names, what):
+    if not isinstance(names, list) or not all(
+            isinstance(x, string_types) and x for x in names):
+        raise ValueError('Invalid %s' % what)
+
+
+def _check_job(body):
+    """ validate a job submission, raising ValueError
+
+    Returns:
+      (kind, payload) for the job
+    """
+    if not isinstance(body, dict):
+        raise ValueError('Job is not an object')
+
+    kind = body.get('kind')
+    if kind not in JOB_KINDS:
+        raise ValueError('Unknown job kind')
+
+    if kind == 'replace_members':
+        if not isinstance(body.get('group'), string_types):
+            raise ValueError('Missing group')
+        _check_names(body.get('users'), 'users')
+        return kind, {'group': body['group'], 'users': body['users']}
+
+    if kind == 'delete_users':
+        _check_names(body.get('users'), 'users')
+        return kind, {'users': body['users']}
+
+    records = body.get('users')
+    if not isinstance(records, list):
+        raise ValueError('Invalid users')
+
+    seen = set()
+    for record in records:
+        _check_record(record)
+        if record['userid'] in seen:
+            raise ValueError('Duplicate userid %s' % record['userid'])
+        seen.add(record['userid'])
+
+    return kind, {'users': records}
+
+
+class Job(restful.Resource):
+    """ bulk job status """
+
+    @jobs_api.representation('text/plain')
+    def _plain(self, data, code, headers=None):
+        resp = make_response(data, code)
+        resp.headers.extend(headers or {})
+        return resp
+
+    def get(self, job_id):
+        """ get the state of a job
+
+        Returns:
+          200 - json object with the job's 'status' (queued, running,
+                done or failed), 'total' and 'done' counts, and its
+                'result' or 'error' once finished
+          404 - no such job
+        """
+        job = get_job(job_id)
+        if job is None:
+            return self._plain('Job not found', 404)
+
+        return job
+
+
+class JobsList(restful.Resource):
+    """ submit bulk jobs """
+
+    @jobs_api.representation('text/plain')
+    def _plain(self, data, code, headers=None):
+        resp = make_response(data, code)
+        resp.headers.extend(headers or {})
+        return resp
+
+    def post(self):
+        """ queue a bulk job, which runs in the background
+
+        Takes a json object with a 'kind' of:
+          replace_members - set the members of 'group' to the list of
+                            'users'
+          delete_users - delete the list of 'users'
+          upsert_users - create or update the list of user records in
+                         'users', as in a bulk POST to /users/
+
+        Returns:
+          202 - queued, with the job's 'id' and a Location to poll
+          400 - invalid job
+        """
+        try:
+            kind, payload = _check_job(json.loads(request.data))
+        except ValueError as e:
+            return self._plain(str(e), 400)
+
+        job = JobModel(kind, payload)
+        db.session.add(job)
+        db.session.commit()
+
+        get_worker().notify()
+
+        return ({'id': job.id, 'status': job.status}, 202,
+                {'Location': url_for('jobs.job', job_id=job.id)})
+
+
+jobs_api.add_resource(Job, '/<int:job_id>')
+jobs_api.add_resource(JobsList, '/')
@@ -0,0 +1,25 @@
+from flask import Blueprint, make_response
+from flask.ext import restful
+
+from userapi.metrics import get_metrics
+
+metrics_bp = Blueprint('metrics', __name__)
+metrics_api = restful.Api(metrics_bp)
+
+
+class Metrics(restful.Resource):
+    """ Prometheus metrics """
+
+    def get(self):
+        """ return the metrics in prometheus text format
+
+        Returns:
+          200 - success
+        """
+        resp = make_response(get_metrics().render(), 200)
+        resp.mimetype = 'text/plain'
+        resp.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return resp
+
+
+metrics_api.add_resource(Metrics, '/')
@@ -0,0 +1,80 @@
+from flask import current_app, request, url_for
+
+from userapi.database import db
+
+
+def requested_ids():
+    """ the ids asked for in a multi-get, from comma separated 'ids'
+    query args, or None if this isn't one
+
+    Raises ValueError when more than MAX_PAGE_SIZE are asked for.
+    """
+    if 'ids' not in request.args:
+        return None
+
+    ids = [x for arg in request.args.getlist('ids')
+           for x in arg.split(',') if x]
+    if len(ids) > current_app.config['MAX_PAGE_SIZE']:
+        raise ValueError('Too many ids')
+
+    return ids
+
+
+def page_limit():
+    """ the 'limit' query arg, capped at MAX_PAGE_SIZE, or None for
+    everything.  Raises ValueError for a bad limit. """
+    limit = request.args.get('limit')
+    if limit is None:
+        return None
+
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError('Invalid limit')
+    return min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+
+def next_page(names, limit):
+    """ trim a page fetched with one extra name, which shows whether
+    there is a next page
+
+    Returns:
+      tuple of the list of names and a dict of response headers
+    """
+    if limit is None or len(names) <= limit:
+        return names, {}
+
+    names = names[:limit]
+    # every value of repeated args, like group filters, carries over
+    args = request.args.to_dict(flat=False)
+    args.update(limit=limit, after=names[-1])
+    link = '<%s>; rel="next"' % url_for(request.endpoint, **args)
+
+    return names, {'Link': link}
+
+
+def paginate(column, query=None):
+    """ list the values of a unique, indexed name column
+
+    Pages are selected with the 'limit' and 'after' query args.  'after'
+    is a keyset cursor (the last name of the previous page), so each page
+    is an index range scan rather than an OFFSET.  When more results are
+    available, a Link header points at the next page.
+
+    Raises ValueError for a bad limit.
+
+    Returns:
+      tuple of the list of names and a dict of response headers
+    """
+    if query is None:
+        query = db.session.query(column)
+    query = query.order_by(column)
+
+    after = request.args.get('after')
+    if after is not None:
+        query = query.filter(column > after)
+
+    limit = page_limit()
+    if limit is not None:
+        query = query.limit(limit + 1)
+
+    return next_page([x[0] for x in query], limit)
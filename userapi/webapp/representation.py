@@ -0,0 +1,63 @@
+# JSON output for the APIs.  Uses ujson or simplejson when installed,
+# writes compact json unless the app is in debug mode, and streams large
+# lists and objects out in pieces rather than as one string.
+
+import json
+
+from flask import Response, current_app
+
+try:
+    import ujson
+
+    def dumps(data):
+        return ujson.dumps(data, ensure_ascii=False,
+                           escape_forward_slashes=False)
+except ImportError:
+    try:
+        import simplejson
+
+        def dumps(data):
+            return simplejson.dumps(data, separators=(',', ':'))
+    except ImportError:
+        def dumps(data):
+            return json.dumps(data, separators=(',', ':'))
+
+# items per piece of a streamed response
+STREAM_CHUNK_SIZE = 500
+
+
+def _iter_json(data):
+    """ encode a big list or dict a slice at a time, dropping each
+    slice's brackets to stitch them together """
+    if isinstance(data, dict):
+        items = list(data.items())
+        yield '{'
+        for start in range(0, len(items), STREAM_CHUNK_SIZE):
+            if start:
+                yield ','
+            yield dumps(dict(items[start:start + STREAM_CHUNK_SIZE]))[1:-1]
+        yield '}\n'
+    else:
+        yield '['
+        for start in range(0, len(data), STREAM_CHUNK_SIZE):
+            if start:
+                yield ','
+            yield dumps(data[start:start + STREAM_CHUNK_SIZE])[1:-1]
+        yield ']\n'
+
+
+def output_json(data, code, headers=None):
+    """ flask-restful representation for application/json """
+    config = current_app.config
+
+    if current_app.debug:
+        body = json.dumps(data, indent=4, sort_keys=True) + '\n'
+    elif (isinstance(data, (list, dict)) and
+            len(data) > config['JSON_STREAM_THRESHOLD']):
+        body = _iter_json(data)
+    else:
+        body = dumps(data) + '\n'
+
+    resp = Response(body, code, mimetype='application/json')
+    resp.headers.extend(headers or {})
+    return resp
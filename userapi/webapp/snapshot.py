@@ -0,0 +1,268 @@
+# Read-only endpoints served from a compiled snapshot (see
+# userapi.snapshot) rather than the database.  They answer the same GET
+# requests as the users, groups and export blueprints, with the same
+# responses; anything else gets a 405.  The blueprints share their names
+# too, so endpoint names (as in CONCURRENCY_LIMITS and RATE_LIMITS) mean
+# the same thing in both modes.
+
+from flask import Blueprint, Response, make_response, request
+from flask.ext import restful
+
+from userapi.snapshot import get_snapshot
+from userapi.webapp.paging import next_page, page_limit, requested_ids
+from userapi.webapp.representation import dumps, output_json
+from userapi.webapp.versioning import etag, not_modified
+
+snapshot_users_bp = Blueprint('users', __name__)
+snapshot_groups_bp = Blueprint('groups', __name__)
+snapshot_export_bp = Blueprint('export', __name__)
+
+
+def _output_plain(data, code, headers=None):
+    resp = make_response(data, code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+def _api(blueprint):
+    api = restful.Api(blueprint)
+    api.representation('application/json')(output_json)
+    api.representation('text/plain')(_output_plain)
+    return api
+
+
+users_api = _api(snapshot_users_bp)
+groups_api = _api(snapshot_groups_bp)
+export_api = _api(snapshot_export_bp)
+
+
+class SnapshotResource(restful.Resource):
+    """ base for the snapshot resources """
+
+    def _plain(self, data, code, headers=None):
+        return _output_plain(data, code, headers)
+
+
+class Users(SnapshotResource):
+    """ User lookups """
+
+    def get(self, userid):
+        """ return the user object
+
+        Returns:
+          200 - success, with user data in json body
+          304 - not modified since the ETag in If-None-Match
+          404 - user does not exist
+        """
+        res = get_snapshot().get_user(userid)
+        if res is None:
+            return self._plain('User not found', 404)
+
+        version, user = res
+        headers = {'ETag': etag(version)}
+        if not_modified(version):
+            return self._plain('', 304, headers)
+
+        return user, 200, headers
+
+
+class EffectiveGroups(SnapshotResource):
+    """ Group membership, including through nested groups """
+
+    def get(self, userid, groupid=None):
+        """ list every group the user is in, directly or through nested
+        groups, or with a groupid, check membership of that group
+
+        Returns:
+          200 - json list of groupids
+          204 - user is in the group
+          404 - user not found, or not in the group
+        """
+        snapshot = get_snapshot()
+        if groupid is not None:
+            if snapshot.is_effective_member(userid, groupid):
+                return self._plain('', 204)
+            return self._plain('Not a member', 404)
+
+        groups = snapshot.get_effective_groups(userid)
+        if groups is None:
+            return self._plain('User not found', 404)
+
+        return groups
+
+
+class UsersList(SnapshotResource):
+    """ see the whole user list """
+
+    def get(self):
+        """ list userids, taking the same query args as the database
+        backed list
+
+        Returns:
+          200 - json list of userids, with a Link header to the next page
+          304 - snapshot not changed since the ETag in If-None-Match
+          400 - invalid limit or match, or too many ids
+        """
+        snapshot = get_snapshot()
+        serial = snapshot.serial
+        if not_modified(serial):
+            return self._plain('', 304, {'ETag': etag(serial)})
+
+        try:
+            ids = requested_ids()
+        except ValueError as e:
+            return self._plain(str(e), 400)
+
+        if ids is not None:
+            users = snapshot.get_users(ids)
+            return (dict((x, users.get(x)) for x in ids), 200,
+                    {'ETag': etag(serial)})
+
+        args = request.args
+        match = args.get('match', 'any')
+        if match not in ['any', 'all']:
+            return self._plain('Invalid match', 400)
+
+        try:
+            limit = page_limit()
+        except ValueError:
+            return self._plain('Invalid limit', 400)
+
+        groups = [x for arg in args.getlist('group')
+                  for x in arg.split(',') if x]
+        names = snapshot.list_users(
+            after=args.get('after'),
+            count=None if limit is None else limit + 1,
+            prefix=args.get('prefix'), name=args.get('name'),
+            groups=groups, match_all=match == 'all')
+
+        names, headers = next_page(names, limit)
+        headers['ETag'] = etag(serial)
+        return names, 200, headers
+
+
+class Groups(SnapshotResource):
+    """ Group lookups """
+
+    def get(self, groupid):
+        """ get the members of the specified group
+
+        Returns:
+          200 - if group exists, plus json list of users
+          304 - not modified since the ETag in If-None-Match
+          404 - if group does not exist
+        """
+        res = get_snapshot().get_group_members(groupid)
+        if res is None:
+            return self._plain('Group not found', 404)
+
+        version, members = res
+        headers = {'ETag': etag(version)}
+        if not_modified(version):
+            return self._plain('', 304, headers)
+
+        if len(members) == 0:
+            return self._plain('Group empty', 404)
+
+        return members, 200, headers
+
+
+class GroupMembers(SnapshotResource):
+    """ Membership checks """
+
+    def get(self, groupid, userid):
+        """ check whether a user is a direct member of the group
+
+        Returns:
+          204 - user is in the group
+          404 - user is not in the group, or either does not exist
+        """
+        if not get_snapshot().is_member(userid, groupid):
+            return self._plain('Not a member', 404)
+
+        return self._plain('', 204)
+
+
+class Subgroups(SnapshotResource):
+    """ Groups nested in a group """
+
+    def get(self, groupid):
+        """ list the groups nested directly in the specified group
+
+        Returns:
+          200 - json list of groupids
+          404 - group not found
+        """
+        groups = get_snapshot().get_subgroups(groupid)
+        if groups is None:
+            return self._plain('Group not found', 404)
+
+        return groups
+
+
+class GroupsList(SnapshotResource):
+    """ see the whole group list """
+
+    def get(self):
+        """ list groupids, taking the same query args as the database
+        backed list
+
+        Returns:
+          200 - json list of groupids, with a Link header to the next page
+          304 - snapshot not changed since the ETag in If-None-Match
+          400 - invalid limit, or too many ids
+        """
+        snapshot = get_snapshot()
+        serial = snapshot.serial
+        if not_modified(serial):
+            return self._plain('', 304, {'ETag': etag(serial)})
+
+        try:
+            ids = requested_ids()
+        except ValueError as e:
+            return self._plain(str(e), 400)
+
+        if ids is not None:
+            groups = snapshot.get_groups_members(ids)
+            return (dict((x, groups.get(x)) for x in ids), 200,
+                    {'ETag': etag(serial)})
+
+        try:
+            limit = page_limit()
+        except ValueError:
+            return self._plain('Invalid limit', 400)
+
+        names = snapshot.list_groups(
+            after=request.args.get('after'),
+            count=None if limit is None else limit + 1)
+
+        names, headers = next_page(names, limit)
+        headers['ETag'] = etag(serial)
+        return names, 200, headers
+
+
+class Export(SnapshotResource):
+    """ Full directory export """
+
+    def get(self):
+        """ stream every user, with names and groups, as newline
+        delimited json
+
+        Returns:
+          200 - success, with one json user object per line
+        """
+        lines = (dumps(x) + '\n' for x in get_snapshot().iter_users())
+        return Response(lines, mimetype='application/x-ndjson')
+
+
+users_api.add_resource(Users, '/<string:userid>')
+users_api.add_resource(EffectiveGroups,
+                       '/<string:userid>/effective-groups',
+                       '/<string:userid>/effective-groups/<string:groupid>')
+users_api.add_resource(UsersList, '/')
+groups_api.add_resource(Groups, '/<string:groupid>')
+groups_api.add_resource(GroupMembers,
+                        '/<string:groupid>/members/<string:userid>')
+groups_api.add_resource(Subgroups, '/<string:groupid>/subgroups')
+groups_api.add_resource(GroupsList, '/')
+export_api.add_resource(Export, '/')
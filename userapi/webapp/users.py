@@ -2,13 +2,22 @@ import json
 
 from flask import Blueprint, request, make_response
 from flask.ext import restful
+from six import string_types
 from sqlalchemy.exc import SQLAlchemyError
 
 from userapi.database import db
-from userapi.database.model import UserModel
+from userapi.database.model import (UserModel, current_serial,
+                                    delete_users, get_effective_groups,
+                                    get_user, get_user_version, get_users,
+                                    is_effective_member, touch, user_filters)
+from userapi.webapp.paging import paginate, requested_ids
+from userapi.webapp.representation import output_json
+from userapi.webapp.versioning import etag, not_modified, versioned_get
+from userapi.writes import Rollback, apply_write
 
 users_bp = Blueprint('users', __name__)
 users_api = restful.Api(users_bp)
+users_api.representation('application/json')(output_json)
 
 
 class Users(restful.Resource):
@@ -26,17 +35,21 @@ class Users(restful.Resource):
 
         Returns:
           200 - success, with user data in json body
+          304 - not modified since the ETag in If-None-Match
           404 - user does not exist
         """
-
-        keys = ['userid', 'first_name', 'last_name', 'groups']
-
-        user = UserModel.query.filter_by(userid=userid).first()
-        if not user:
+        res = versioned_get(('user', userid),
+                            lambda: get_user_version(userid),
+                            lambda: get_user(userid))
+        if not res:
             return self._plain('User not found', 404)
 
-        # return only a subset of the user object keys
-        return dict((key, getattr(user, key)) for key in keys)
+        version, user = res
+        headers = {'ETag': etag(version)}
+        if user is None:
+            return self._plain('', 304, headers)
+
+        return user, 200, headers
 
     def delete(self, userid):
         """ delete the specified user object
@@ -46,91 +59,314 @@ class Users(restful.Resource):
           404 - user does not exist
           200 - success
         """
-        user = UserModel.query.filter_by(userid=userid).first()
-        if not user:
-            return self._plain('User not found', 404)
+        def write():
+            if not delete_users([userid]):
+                raise Rollback(('User not found', 404))
+
+            return 'Deleted successfully', 200
 
         try:
-            db.session.delete(user)
+            return self._plain(*apply_write(write))
         except SQLAlchemyError:
-            db.session.rollback()
             return self._plain('Error deleting user', 500)
 
-        db.session.commit()
-
-        return self._plain('Deleted successfully', 200)
-
     def post(self, userid):
         """ create user object
 
         Returns:
-          400 - invalid json
+          400 - invalid json, or invalid fields
           409 - object exists
           201 - created object
         """
-        if UserModel.query.filter_by(userid=userid).first():
-            return self._plain("User Exists", 409)
-
         try:
             data = json.loads(request.data)
         except ValueError:
             return self._plain("Invalid json", 400)
 
+        try:
+            _check_user(data)
+        except ValueError as e:
+            return self._plain(str(e), 400)
+
         first = '' if 'first_name' not in data else data['first_name']
         last = '' if 'last_name' not in data else data['last_name']
 
-        new_user = UserModel(userid, first_name=first, last_name=last)
+        def write():
+            if UserModel.query.filter_by(userid=userid).first():
+                raise Rollback(("User Exists", 409))
 
-        try:
+            new_user = UserModel(userid, first_name=first, last_name=last)
             db.session.add(new_user)
-        except SQLAlchemyError:
-            db.session.rollback()
-            return self._plain('Error creating user', 500)
 
-        db.session.commit()
+            # now, add the groups, if specified
+            if 'groups' in data:
+                new_user.groups = data['groups']
 
-        # now, add the groups, if specified
-        if 'groups' in data:
-            new_user.groups = data['groups']
-            db.session.commit()
+            touch(users=[userid], groups=data.get('groups', []))
+            return 'Added Successfully', 201
 
-        return self._plain('Added Successfully', 201)
+        try:
+            return self._plain(*apply_write(write))
+        except SQLAlchemyError:
+            return self._plain('Error creating user', 500)
 
     def put(self, userid):
         """ update a user object
 
         Returns:
           200 - success
-          400 - bad json
+          400 - bad json, or invalid fields
           404 - user not found
         """
-        update_user = UserModel.query.filter_by(userid=userid).first()
-        if not update_user:
-            return self._plain('User not found', 404)
-
         try:
             data = json.loads(request.data)
         except ValueError:
             return self._plain('Invalid JSON', 400)
 
-        db.session.add(update_user)
         try:
+            _check_user(data)
+        except ValueError as e:
+            return self._plain(str(e), 400)
+
+        def write():
+            update_user = UserModel.query.filter_by(userid=userid).first()
+            if not update_user:
+                raise Rollback(('User not found', 404))
+
+            # only groups the user joined or left have changed
+            groups = set()
+            if 'groups' in data:
+                groups = set(update_user.groups).symmetric_difference(
+                    data['groups'])
+
             for field in ['first_name', 'last_name', 'groups']:
                 if field in data:
                     setattr(update_user, field, data[field])
+
+            touch(users=[userid], groups=groups)
+            return 'User updated', 200
+
+        try:
+            return self._plain(*apply_write(write))
         except SQLAlchemyError:
-            db.session.rollback()
             return self._plain('Error updating user', 500)
 
-        db.session.commit()
-        return self._plain('User updated', 200)
+
+# placeholder for unparseable lines in an ndjson bulk upload
+_INVALID_JSON = object()
+
+
+class EffectiveGroups(restful.Resource):
+    """ Group membership, including through nested groups """
+
+    @users_api.representation('text/plain')
+    def _plain(self, data, code, headers=None):
+        """ Text/plain output function """
+        resp = make_response(data, code)
+        resp.headers.extend(headers or {})
+        return resp
+
+    def get(self, userid, groupid=None):
+        """ list every group the user is in, directly or through nested
+        groups, or with a groupid, check membership of that group
+
+        Returns:
+          200 - json list of groupids
+          204 - user is in the group
+          404 - user not found, or not in the group
+        """
+        if groupid is not None:
+            if is_effective_member(userid, groupid):
+                return self._plain('', 204)
+            return self._plain('Not a member', 404)
+
+        groups = get_effective_groups(userid)
+        if groups is None:
+            return self._plain('User not found', 404)
+
+        return groups
+
+
+def _check_user(record):
+    """ validate the fields of a user record, raising ValueError """
+    if not isinstance(record, dict):
+        raise ValueError('Record is not an object')
+
+    for field in ['first_name', 'last_name']:
+        if field in record and not isinstance(record[field], string_types):
+            raise ValueError('Invalid %s' % field)
+
+    if 'groups' in record:
+        groups = record['groups']
+        if not isinstance(groups, list) or not all(
+                isinstance(x, string_types) and x for x in groups):
+            raise ValueError('Invalid groups')
+
+
+def _check_record(record):
+    """ validate one record of a bulk upsert, raising ValueError """
+    if record is _INVALID_JSON:
+        raise ValueError('Invalid json')
+
+    _check_user(record)
+
+    userid = record.get('userid')
+    if not isinstance(userid, string_types) or not userid:
+        raise ValueError('Missing userid')
 
 
 class UsersList(restful.Resource):
     """ see the whole user list """
+
+    @users_api.representation('text/plain')
+    def _plain(self, data, code, headers=None):
+        """ Text/plain output function """
+        resp = make_response(data, code)
+        resp.headers.extend(headers or {})
+        return resp
+
     def get(self):
-        return [x.userid for x in UserModel.query.all()]
+        """ list userids
+
+        With an 'ids' query arg of comma separated userids, returns a
+        json object of each of those userids to its user record, or to
+        null for users that don't exist.
+
+        Otherwise takes optional 'limit' and 'after' query args to page
+        through the list in userid order, and these filters:
+
+          prefix - userid starts with this
+          name - first or last name starts with this, ignoring case
+          group - comma separated groupids, may be repeated
+          match - 'any' (default) or 'all' of the groups
+
+        Returns:
+          200 - json list of userids, with a Link header to the next page
+          304 - directory not modified since the ETag in If-None-Match
+          400 - invalid limit or match, or too many ids
+        """
+        serial = current_serial()
+        if not_modified(serial):
+            return self._plain('', 304, {'ETag': etag(serial)})
+
+        try:
+            ids = requested_ids()
+        except ValueError as e:
+            return self._plain(str(e), 400)
+
+        if ids is not None:
+            users = get_users(ids)
+            return (dict((x, users.get(x)) for x in ids), 200,
+                    {'ETag': etag(serial)})
+
+        args = request.args
+        match = args.get('match', 'any')
+        if match not in ['any', 'all']:
+            return self._plain('Invalid match', 400)
+
+        groups = [x for arg in args.getlist('group')
+                  for x in arg.split(',') if x]
+        query = db.session.query(UserModel.userid).filter(*user_filters(
+            prefix=args.get('prefix'), name=args.get('name'),
+            groups=groups, match_all=match == 'all'))
+
+        try:
+            names, headers = paginate(UserModel.userid, query)
+        except ValueError:
+            return self._plain('Invalid limit', 400)
+
+        headers['ETag'] = etag(serial)
+        return names, 200, headers
+
+    def post(self):
+        """ create or update many users in a single transaction
+
+        Takes either a json list of user records, or newline delimited
+        json records with a content type of application/x-ndjson.  Each
+        record has a 'userid', plus optional 'first_name', 'last_name'
+        and 'groups' which behave as they do in a PUT.
+
+        Returns:
+          200 - processed, with a json list of per-record results
+          400 - invalid json
+          500 - internal sql alchemy error
+        """
+        if request.mimetype == 'application/x-ndjson':
+            records = []
+            for line in request.stream:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    records.append(_INVALID_JSON)
+        else:
+            try:
+                records = json.loads(request.data)
+            except ValueError:
+                return self._plain('Invalid json', 400)
+
+            if not isinstance(records, list):
+                return self._plain('Invalid json', 400)
+
+        results = []
+        valid = []
+        seen = set()
+        for record in records:
+            try:
+                _check_record(record)
+                if record['userid'] in seen:
+                    raise ValueError('Duplicate userid')
+            except ValueError as e:
+                results.append({'status': 'error', 'error': str(e)})
+                continue
+
+            seen.add(record['userid'])
+            valid.append(record)
+            results.append({'userid': record['userid']})
+
+        try:
+            status = apply_write(lambda: UserModel.upsert_many(valid))
+        except SQLAlchemyError:
+            return self._plain('Error updating users', 500)
+
+        for result in results:
+            if 'userid' in result:
+                result['status'] = status[result['userid']]
+
+        return results
+
+    def delete(self):
+        """ delete many users in a single transaction
+
+        Takes an 'ids' query arg of comma separated userids.
+
+        Returns:
+          200 - json object with the 'deleted' userids, and the 'missing'
+                ones that did not exist
+          400 - no ids, or too many
+          500 - internal sql alchemy error
+        """
+        try:
+            ids = requested_ids()
+        except ValueError as e:
+            return self._plain(str(e), 400)
+
+        if not ids:
+            return self._plain('Missing ids', 400)
+
+        try:
+            deleted = apply_write(lambda: delete_users(ids))
+        except SQLAlchemyError:
+            return self._plain('Error deleting users', 500)
+
+        found = set(deleted)
+        return {'deleted': deleted,
+                'missing': [x for x in ids if x not in found]}
 
 
 users_api.add_resource(Users, '/<string:userid>')
+users_api.add_resource(EffectiveGroups,
+                       '/<string:userid>/effective-groups',
+                       '/<string:userid>/effective-groups/<string:groupid>')
 users_api.add_resource(UsersList, '/')
@@ -0,0 +1,56 @@
+from flask import request
+
+from userapi.cache import cached
+
+
+class _NotModified(Exception):
+    def __init__(self, version):
+        self.version = version
+
+
+# compressed responses get their content coding appended to the ETag
+# (see userapi.compression), so each encoding has a tag of its own
+ETAG_ENCODINGS = ('gzip', 'deflate')
+
+
+def etag(version):
+    return '"%d"' % version
+
+
+def not_modified(version):
+    """ does the client already hold this version, in any encoding? """
+    tags = [str(version)] + ['%d-%s' % (version, x) for x in ETAG_ENCODINGS]
+    return any(request.if_none_match.contains_weak(x) for x in tags)
+
+
+def versioned_get(key, get_version, load):
+    """ read a versioned object through the cache, honouring If-None-Match
+
+    On a cache miss the version is checked first with get_version, a
+    single indexed lookup, so an object the client already has is never
+    loaded or serialized.  load fetches the full object.  Both return
+    None if the object does not exist.
+
+    Returns:
+      tuple of (version, data), where data is None if the client copy
+      is current, or None if the object does not exist
+    """
+    def loader():
+        version = get_version()
+        if version is None:
+            return None
+
+        if not_modified(version):
+            raise _NotModified(version)
+
+        return load()
+
+    try:
+        res = cached(key, loader)
+    except _NotModified as e:
+        return e.version, None
+
+    if res is not None and not_modified(res[0]):
+        return res[0], None
+
+    return res
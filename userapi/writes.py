@@ -0,0 +1,193 @@
+# Commits for the write endpoints.
+#
+# Handlers put their changes in a function and hand it to apply_write.
+# Normally that runs it and commits.  With WRITE_BATCHING set, functions
+# from concurrent requests are queued instead, and a writer thread
+# applies up to WRITE_BATCH_MAX of them at a time, each in a savepoint of
+# its own, then commits them together.  A burst of writes then costs one
+# transaction and one fsync per batch rather than per request, and the
+# requests don't fight over the sqlite write lock.  Each request still
+# gets its own result, or its own error.
+#
+# Write functions run on the writer thread, so they must do their own
+# lookups in db.session, and must not touch the request.
+
+import threading
+import time
+
+from flask import current_app
+
+from userapi.database import db, write_transactions
+
+
+class Rollback(Exception):
+    """ raise from a write function to undo its changes, and have
+    apply_write return response instead """
+
+    def __init__(self, response):
+        super(Rollback, self).__init__(response)
+        self.response = response
+
+
+class _Write(object):
+    def __init__(self, fn):
+        self.fn = fn
+        self.queued = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WriteBatcher(object):
+    """ applies queued writes in batches on a writer thread, started on
+    first use """
+
+    def __init__(self, app):
+        self.app = app
+        self.window = app.config['WRITE_BATCH_WINDOW']
+        self.max_size = app.config['WRITE_BATCH_MAX']
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._stopping = False
+        self._thread = None
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._writes = 0
+        self._largest = 0
+        self._wait = 0.0
+
+    def submit(self, fn):
+        """ queue a write function and wait for its batch to commit
+
+        Returns:
+          whatever fn returned, or the response of a Rollback it raised.
+          Exceptions from fn, or from the commit, are raised here.
+        """
+        write = _Write(fn)
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run,
+                                                name='userapi-writes')
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._queue.append(write)
+            self._cond.notify()
+
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+
+        return write.result
+
+    def stop(self, timeout=None):
+        """ stop the writer once the writes already queued are done """
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._cond.notify()
+
+        if thread is not None:
+            thread.join(timeout)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue:
+                if self._stopping:
+                    return None
+                self._cond.wait()
+
+            # give other requests the rest of the window to join in
+            deadline = self._queue[0].queued + self.window
+            while len(self._queue) < self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = self._queue[:self.max_size]
+            self._queue = self._queue[self.max_size:]
+            return batch
+
+    def _apply(self, batch):
+        try:
+            for write in batch:
+                try:
+                    with db.session.begin_nested():
+                        write.result = write.fn()
+                except Rollback as e:
+                    write.result = e.response
+                except Exception as e:
+                    write.error = e
+
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for write in batch:
+                if write.error is None:
+                    write.error = e
+        finally:
+            db.session.remove()
+
+    def _run(self):
+        with self.app.app_context(), write_transactions():
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+
+                self._apply(batch)
+
+                now = time.time()
+                with self._stats_lock:
+                    self._batches += 1
+                    self._writes += len(batch)
+                    self._largest = max(self._largest, len(batch))
+                    self._wait += sum(now - x.queued for x in batch)
+
+                for write in batch:
+                    write.done.set()
+
+    def stats(self):
+        with self._stats_lock:
+            return {'batches': self._batches,
+                    'writes': self._writes,
+                    'largest': self._largest,
+                    'wait': self._wait}
+
+
+def apply_write(fn):
+    """ run a write function, which makes its changes in db.session and
+    returns a response, and commit it, batched with other requests'
+    writes if WRITE_BATCHING is set
+
+    Returns:
+      whatever fn returned, or the response of a Rollback it raised
+    """
+    batcher = get_batcher()
+    if batcher is not None:
+        return batcher.submit(fn)
+
+    try:
+        res = fn()
+    except Rollback as e:
+        db.session.rollback()
+        return e.response
+    except Exception:
+        db.session.rollback()
+        raise
+
+    db.session.commit()
+    return res
+
+
+def init_writes(app):
+    if app.config['WRITE_BATCHING']:
+        app.extensions['userapi_writes'] = WriteBatcher(app)
+
+
+def get_batcher():
+    return current_app.extensions.get('userapi_writes')